@@ -0,0 +1,166 @@
+"""
+Benchmarks for the piano-tune compile pipeline, run outside of Sublime Text.
+
+    python benchmarks/compile_pipeline.py [--sizes 1000 10000 ...] [--output results.json]
+
+Synthetic tunes are generated for each size (the number of notes played once
+labels are expanded), and each stage of the pipeline is timed, along with the
+peak memory it allocates, measured separately with tracemalloc. The results are
+written as JSON, so they can be compared across commits.
+
+No stand in for the sublime module is needed, as piano_tunes falls back to its
+own tokenizer and Region when sublime can't be imported; mido is required.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import piano_tunes
+
+
+NOTE_NAMES = 'do re mi fa sol la si'.split()
+LABEL_NOTES = 8
+
+
+def generate_tune(notes, label_depth=2, references=16, chord_density=0.1, seed=0):
+    """
+    Generate a piano-tune which plays (roughly) the given number of notes.
+
+    label_depth labels are defined, each of LABEL_NOTES notes, where every label
+    references the one before it; references is how many times the outermost
+    label is referenced, and chord_density is the chance that a note in the
+    body of the tune is played as a three note chord instead.
+    """
+    rng = random.Random(seed)
+    lines = ['t160 o4']
+
+    def random_notes(count):
+        return ' '.join(rng.choice(NOTE_NAMES) + ('#' if rng.random() < 0.1 else '') for _ in range(count))
+
+    for depth in range(label_depth):
+        lines.append('label-%d:' % depth)
+        if depth:
+            lines.append('&label-%d' % (depth - 1))
+        lines.append('l16 ' + random_notes(LABEL_NOTES))
+        lines.append('---')
+    # the definitions are played where they are defined, too
+    played = LABEL_NOTES * label_depth * (label_depth + 1) // 2
+
+    notes_per_reference = LABEL_NOTES * label_depth
+    references = min(references, max(0, notes - played) // max(1, notes_per_reference)) if label_depth else 0
+    body_notes = max(0, notes - played - references * notes_per_reference)
+    reference_every = body_notes // references if references else 0
+
+    line = list()
+    while body_notes > 0:
+        if rng.random() < chord_density and body_notes >= 3:
+            line.append('/ %s /' % random_notes(3))
+            body_notes -= 3
+        else:
+            line.append(random_notes(1))
+            body_notes -= 1
+        if references and reference_every and body_notes % reference_every == 0:
+            line.append('&label-%d' % (label_depth - 1))
+            references -= 1
+        if len(line) >= 16:
+            lines.append(' '.join(line))
+            line = list()
+    while references > 0:
+        line.append('&label-%d' % (label_depth - 1))
+        references -= 1
+    lines.append(' '.join(line))
+    return '\n'.join(lines) + '\n'
+
+
+def run_stages(text):
+    """run each stage of the pipeline, yielding (stage name, function); each
+    function runs a stage on the result of the previous ones"""
+    results = dict()
+    yield 'tokenize', lambda: results.__setitem__('tokens', list(piano_tunes.tokenize_piano_tune(text)))
+    yield 'parse', lambda: results.__setitem__('instructions', list(piano_tunes.parse_piano_tune(results['tokens'])))
+    yield 'resolve', lambda: results.__setitem__('states', piano_tunes.resolve_piano_tune_instructions(results['instructions']))
+    yield 'convert', lambda: results.__setitem__('events', list(piano_tunes.iter_piano_tune_midi(results['states'])))
+    yield 'compile', lambda: results.__setitem__('tune', piano_tunes.compile_piano_tune(results['instructions']))
+    yield 'export', lambda: results.__setitem__('midi', piano_tunes.piano_tune_to_midi_file(results['tune'].events()))
+
+
+def time_stages(text, repeat):
+    """the best time in seconds, out of repeat runs, for each stage"""
+    timings = dict()
+    for _ in range(repeat):
+        for stage, run in run_stages(text):
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            timings[stage] = min(elapsed, timings.get(stage, elapsed))
+    return timings
+
+
+def measure_stages(text):
+    """the peak memory allocated in bytes by each stage"""
+    peaks = dict()
+    for stage, run in run_stages(text):
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peaks[stage] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peaks
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the piano-tune compile pipeline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='numbers of notes to generate tunes with')
+    parser.add_argument('--label-depth', type=int, default=2)
+    parser.add_argument('--references', type=int, default=16)
+    parser.add_argument('--chord-density', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3, help='take the best time of this many runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    results = list()
+    for size in args.sizes:
+        text = generate_tune(size, args.label_depth, args.references, args.chord_density, args.seed)
+        timings = time_stages(text, args.repeat)
+        peaks = measure_stages(text)
+        results.append({
+            'notes': size,
+            'characters': len(text),
+            'stages': { stage: { 'seconds': timings[stage], 'peak_bytes': peaks[stage] } for stage in timings },
+        })
+        print('%8d notes: %s' % (size, ', '.join('%s %.3f s' % (stage, seconds) for stage, seconds in timings.items())), file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': { 'label_depth': args.label_depth, 'references': args.references, 'chord_density': args.chord_density, 'repeat': args.repeat, 'seed': args.seed },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Microbenchmark for sending notes to a midi output port, comparing building a
+mido.Message for every note against sending the pre-encoded bytes from
+piano_midi_output, run outside of Sublime Text.
+
+    python benchmarks/midi_output.py [--messages 100000] [--rtmidi] [--output results.json]
+
+By default the notes go to stand in ports that throw them away, so only the
+cost of the send path itself is measured; with --rtmidi they go to a virtual
+rtmidi output port (which needs python-rtmidi, and a platform that supports
+virtual ports), so the time spent in the backend is included too.
+
+The results are written as JSON, in messages per second for each path, so
+they can be compared across commits.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import mido
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import piano_midi_output
+
+
+# The size of the chords sent as a burst in the chord paths
+CHORD_SIZE = 4
+
+
+class NullRtMidi:
+    """stands in for an rtmidi.MidiOut, throwing away everything it's sent"""
+    def send_message(self, data):
+        pass
+
+
+class NullOutput(mido.ports.BaseOutput):
+    """
+    A mido output port that throws away everything it's sent, after mido has
+    checked and copied it; it has an _rt like the rtmidi backend's ports, so
+    the raw path sends straight to that.
+    """
+    def _open(self, **kwargs):
+        self._rt = NullRtMidi()
+
+    def _send(self, msg):
+        self._rt.send_message(msg.bytes())
+
+
+def notes(count):
+    """the midi notes to send, a spread over the keyboard like a tune's"""
+    return [36 + (index * 7) % 48 for index in range(count)]
+
+
+def send_mido(port, note_numbers):
+    for note in note_numbers:
+        port.send(mido.Message('note_on', note=note))
+        port.send(mido.Message('note_off', note=note))
+
+
+def send_raw(port, note_numbers):
+    output = piano_midi_output.RawMidiOutput(port)
+    for note in note_numbers:
+        output.note(note, True)
+        output.note(note, False)
+
+
+def send_mido_chords(port, note_numbers):
+    for index in range(0, len(note_numbers), CHORD_SIZE):
+        chord = note_numbers[index:index + CHORD_SIZE]
+        for note in chord:
+            port.send(mido.Message('note_on', note=note))
+        for note in chord:
+            port.send(mido.Message('note_off', note=note))
+
+
+def send_raw_chords(port, note_numbers):
+    output = piano_midi_output.RawMidiOutput(port)
+    note_message = piano_midi_output.note_message
+    for index in range(0, len(note_numbers), CHORD_SIZE):
+        chord = note_numbers[index:index + CHORD_SIZE]
+        output.send_burst([note_message(note, True) for note in chord])
+        output.send_burst([note_message(note, False) for note in chord])
+
+
+PATHS = {
+    'mido': send_mido,
+    'raw': send_raw,
+    'mido_chords': send_mido_chords,
+    'raw_chords': send_raw_chords,
+}
+
+
+def time_path(send, port, note_numbers, repeat):
+    """the best rate in messages per second, out of repeat runs"""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        send(port, note_numbers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # a note on and a note off for every note
+    return len(note_numbers) * 2 / best
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark sending notes to a midi output port.')
+    parser.add_argument('--messages', type=int, default=100000, help='number of note on/off pairs to send')
+    parser.add_argument('--rtmidi', action='store_true', help='send to a virtual rtmidi port instead of a stand in')
+    parser.add_argument('--repeat', type=int, default=5, help='take the best time of this many runs')
+    parser.add_argument('--output', default=None, help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.rtmidi:
+        port = mido.open_output('piano benchmark', virtual=True)
+    else:
+        port = NullOutput()
+
+    note_numbers = notes(args.messages)
+    try:
+        rates = { name: time_path(send, port, note_numbers, args.repeat) for name, send in PATHS.items() }
+    finally:
+        port.close()
+
+    for name, rate in rates.items():
+        print('%12s: %12.0f messages/s' % (name, rate), file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mido': str(mido.version_info),
+        'parameters': { 'messages': args.messages, 'rtmidi': args.rtmidi, 'repeat': args.repeat, 'chord_size': CHORD_SIZE },
+        'messages_per_second': rates,
+        'speedup': rates['raw'] / rates['mido'],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+
+# The note indexes of the white keys in an octave, and the names shown under
+# them on the piano
+WHITE_KEYS = (0, 2, 4, 5, 7, 9, 11)
+WHITE_KEY_NAMES = dict(zip(WHITE_KEYS, 'DO RE MI FA SOL LA SI'.split()))
+
+# The note indexes a generated layout can start on; the piano syntax only
+# recognizes a keyboard that starts on a DO or a FA
+START_KEYS = (0, 5)
+
+# The highest midi note that can be shown on the piano
+MAX_NOTE = 127
+
+# The number of rows of the keyboard that show the black keys
+BLACK_KEY_ROWS = 4
+# The number of rows below those that only show the white keys
+WHITE_KEY_ROWS = 2
+
+# The name of a generated layout; i.e. piano_keys_24-71 for the keys from midi
+# note 24 to midi note 71
+LAYOUT_NAME_RE = re.compile(r'^piano_keys_(\d+)-(\d+)$')
+
+
+class PianoLayout(NamedTuple):
+    """
+    A piano layout; the text of the keyboard to put in the piano view, the
+    settings to give the view, and the offsets into the text of the parts of
+    each key, per (octave, note_index), so the display driver doesn't need to
+    scan the keyboard to find them.
+    """
+    text: str
+    settings: dict
+    key_regions: dict
+
+
+def layout_name(first_note, last_note):
+    return 'piano_keys_%d-%d' % (first_note, last_note)
+
+
+def parse_layout_name(name):
+    """the (first_note, last_note) range of a generated layout name, or None"""
+    match = LAYOUT_NAME_RE.match(name or '')
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def layout_range(first_note, last_note):
+    """
+    The range of keys that will actually be shown for a range of midi notes;
+    the start moves down to a DO or FA, the end moves up to a white key, and
+    the keyboard is at least an octave wide.
+    """
+    first_note = max(0, min(first_note, MAX_NOTE - 12))
+    first_note -= first_note % 12 - max(key for key in START_KEYS if key <= first_note % 12)
+    last_note = max(last_note, first_note + 11)
+    while last_note % 12 not in WHITE_KEYS:
+        last_note += 1
+    return first_note, min(last_note, MAX_NOTE)
+
+
+def piano_layout(name):
+    """the generated layout for a layout name, or None if it's not one"""
+    note_range = parse_layout_name(name)
+    if note_range is None:
+        return None
+    return generate_piano_layout(*layout_range(*note_range))
+
+
+@lru_cache(maxsize=16)
+def generate_piano_layout(first_note, last_note):
+    """
+    Draw the keyboard for the keys from first_note to last_note, which should
+    come from layout_range; this is the same box drawing as the layouts that
+    ship with the package.
+
+    Each white key is 4 columns wide at the bottom of the keyboard, counting
+    the border to its left, and each black key sits on the border between two
+    white keys, 1 column wide with a border either side of it.
+    """
+    whites = [note for note in range(first_note, last_note + 1) if note % 12 in WHITE_KEYS]
+    width = len(whites) * 4 + 1
+    # the column of the border to the left of each white key after the first,
+    # and the black key that sits on it, if any
+    borders = [(index * 4, whites[index] - 1 if whites[index] - whites[index - 1] == 2 else None) for index in range(1, len(whites))]
+
+    upper = [' '] * width
+    transition = [' '] * width
+    lower = [' '] * width
+    for row in (upper, transition, lower):
+        row[0] = row[-1] = '│'
+    for column, black in borders:
+        lower[column] = '│'
+        if black is None:
+            upper[column] = transition[column] = '│'
+        else:
+            upper[column - 1] = upper[column + 1] = '│'
+            transition[column - 1:column + 2] = '└┬┘'
+
+    top = ['┬' if char == '│' else '─' for char in upper]
+    top[0], top[-1] = '┌', '┐'
+    bottom = ['┴' if char == '│' else '─' for char in lower]
+    bottom[0], bottom[-1] = '└', '┘'
+
+    names = ' ' + ''.join(WHITE_KEY_NAMES[note % 12].ljust(4) for note in whites)
+
+    octaves = '│'
+    for octave in range(whites[0] // 12, whites[-1] // 12 + 1):
+        size = sum(1 for note in whites if note // 12 == octave) * 4 - 1
+        label = str(octave)
+        if size < len(label) + 4:
+            octaves += label.center(size, '-')
+        else:
+            left = (size - len(label) - 2) // 2
+            octaves += '-' * left + ' ' + label + ' ' + '-' * (size - len(label) - 2 - left)
+        octaves += '│'
+
+    keys_rows = [upper] * BLACK_KEY_ROWS + [transition] + [lower] * WHITE_KEY_ROWS
+    lines = [''.join(top)] + [''.join(row) for row in keys_rows] + [''.join(bottom), names, octaves]
+
+    # The keys are the runs of spaces in each row, in order; every key shows
+    # in the rows with the black keys, and only the white keys below them.
+    key_regions = dict()
+    offset = len(lines[0]) + 1
+    for row_index, line in enumerate(lines[1:1 + len(keys_rows)]):
+        notes = iter(range(first_note, last_note + 1) if row_index < BLACK_KEY_ROWS else whites)
+        for match in re.finditer(r' +', line):
+            note = next(notes)
+            key_regions.setdefault((note // 12, note % 12), list()).append((offset + match.start(), offset + match.end()))
+        offset += len(line) + 1
+
+    return PianoLayout(
+        text='\n'.join(lines) + '\n',
+        settings={'start_octave': str(first_note // 12)},
+        key_regions=key_regions,
+    )
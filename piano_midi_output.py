@@ -0,0 +1,66 @@
+import threading
+import mido
+
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+
+# The velocity mido gives notes when none is set
+DEFAULT_VELOCITY = 64
+
+# The bytes of every note message at the default velocity, indexed by
+# [on][channel][note], so sending a note doesn't have to build anything
+NOTE_MESSAGES = tuple(
+    tuple(
+        tuple(bytes((status | channel, note, DEFAULT_VELOCITY)) for note in range(128))
+        for channel in range(16)
+    )
+    for status in (NOTE_OFF, NOTE_ON)
+)
+
+
+def note_message(note, on=True, channel=0, velocity=DEFAULT_VELOCITY):
+    """the raw bytes of a note on or note off message"""
+    if velocity == DEFAULT_VELOCITY:
+        return NOTE_MESSAGES[on][channel][note]
+    return bytes(((NOTE_ON if on else NOTE_OFF) | channel, note, velocity))
+
+
+class RawMidiOutput:
+    """
+    Sends raw midi bytes to a mido output port; when the port is backed by
+    rtmidi, they go straight to it, skipping building, validating, copying and
+    encoding a mido.Message for every note. Other backends are sent parsed
+    messages as usual.
+
+    The port's own lock is used, so raw sends don't interleave with messages
+    sent to the port through mido.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.lock = getattr(port, '_lock', None) or threading.RLock()
+        rt = getattr(port, '_rt', None)
+        send_message = getattr(rt, 'send_message', None)
+        self.send_raw = send_message if send_message else self.send_parsed
+
+    def send_parsed(self, data):
+        self.port.send(mido.Message.from_bytes(data))
+
+    def send(self, data):
+        with self.lock:
+            if not self.port.closed:
+                self.send_raw(data)
+
+    def send_burst(self, messages):
+        """
+        Send several messages, i.e. the notes of a chord, back to back under
+        one lock, so nothing else sent to the port lands in between them.
+        """
+        with self.lock:
+            if not self.port.closed:
+                send_raw = self.send_raw
+                for data in messages:
+                    send_raw(data)
+
+    def note(self, note, on=True, channel=0):
+        self.send(note_message(note, on, channel))
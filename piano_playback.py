@@ -0,0 +1,637 @@
+import time
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count
+import mido
+
+
+# How long before a deadline to stop sleeping and busy wait instead, in
+# seconds; sleeping is only accurate to around a millisecond on most systems.
+SPIN_THRESHOLD = 0.001
+
+# How many events apart the channel state is snapshotted in a midi file, so a
+# seek only has to replay the events since the nearest snapshot.
+SNAPSHOT_INTERVAL = 1024
+
+
+def percentile(sorted_values, fraction):
+    """the value at the given fraction (0 to 1) through a sorted list"""
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+class LatencyStats:
+    """
+    Keeps count of a latency; a running count, mean and maximum, plus the most
+    recent samples so percentiles can be reported.
+    """
+    def __init__(self, size=1024):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        # the most recent samples, in ms
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.samples.append(ms)
+
+    def stats(self):
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': percentile(samples, 0.5),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+            'max': self.max,
+        }
+
+    def report(self):
+        return 'count: {count}, mean: {mean:.3f} ms, p50: {p50:.3f} ms, p95: {p95:.3f} ms, p99: {p99:.3f} ms, max: {max:.3f} ms'.format(**self.stats())
+
+
+class LatencyRecorder:
+    """
+    Keeps a LatencyStats for each stage of each input path, i.e. how long it
+    takes from a key being pressed on the pc keyboard until the note is sent to
+    the output port, or until the key is drawn on the piano.
+
+    An origin is a tuple of (path, perf_counter time) made when the input is
+    received, which is passed along with the note so each stage it reaches can
+    be recorded against it.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.paths = dict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def origin(path):
+        return (path, time.perf_counter())
+
+    def record(self, origin, stage, now=None):
+        if origin is None:
+            return
+        path, started = origin
+        if now is None:
+            now = time.perf_counter()
+        stats = self.paths.get((path, stage))
+        if stats is None:
+            with self.lock:
+                stats = self.paths.setdefault((path, stage), LatencyStats(self.size))
+        stats.add(now - started)
+
+    def reset(self):
+        with self.lock:
+            self.paths.clear()
+
+    def stats(self):
+        """
+        the stats for each stage, keyed by path then stage; the stages of a
+        path are in the order they were first reached, which is pipeline order
+        """
+        with self.lock:
+            paths = list(self.paths.items())
+        result = dict()
+        for (path, stage), stats in paths:
+            result.setdefault(path, dict())[stage] = stats.stats()
+        return result
+
+    def report(self):
+        lines = list()
+        for path, stages in self.stats().items():
+            lines.append(path)
+            for stage, stats in stages.items():
+                lines.append('  {stage:<10} count: {count}, mean: {mean:.3f} ms, p50: {p50:.3f} ms, p95: {p95:.3f} ms, p99: {p99:.3f} ms, max: {max:.3f} ms'.format(stage=stage, **stats))
+        return '\n'.join(lines) if lines else 'no latency samples recorded yet'
+
+
+class MidiChannelState:
+    """
+    The state of the midi channels at a point in a midi file; the notes that
+    are sounding (with their velocity), and the program, controllers and pitch
+    of each channel. This is what has to be sent to the output port to pick up
+    playback from that point.
+    """
+    __slots__ = ('notes', 'programs', 'controls', 'pitch')
+
+    def __init__(self):
+        self.notes = dict()
+        self.programs = dict()
+        self.controls = dict()
+        self.pitch = dict()
+
+    def copy(self):
+        state = MidiChannelState()
+        state.notes = self.notes.copy()
+        state.programs = self.programs.copy()
+        state.controls = self.controls.copy()
+        state.pitch = self.pitch.copy()
+        return state
+
+    def update(self, data):
+        """update the state with the bytes of a midi message"""
+        kind = data[0] & 0xF0
+        channel = data[0] & 0x0F
+        if kind == 0x90 and data[2] > 0:
+            self.notes[(channel, data[1])] = data[2]
+        elif kind == 0x90 or kind == 0x80:
+            self.notes.pop((channel, data[1]), None)
+        elif kind == 0xC0:
+            self.programs[channel] = data[1]
+        elif kind == 0xB0:
+            self.controls[(channel, data[1])] = data[2]
+        elif kind == 0xE0:
+            self.pitch[channel] = (data[1] | data[2] << 7) - 8192
+
+    def restore_messages(self):
+        """the messages that bring an output port to this state"""
+        for channel, program in self.programs.items():
+            yield mido.Message('program_change', channel=channel, program=program)
+        for (channel, control), value in self.controls.items():
+            yield mido.Message('control_change', channel=channel, control=control, value=value)
+        for channel, pitch in self.pitch.items():
+            yield mido.Message('pitchwheel', channel=channel, pitch=pitch)
+        for (channel, note), velocity in self.notes.items():
+            yield mido.Message('note_on', channel=channel, note=note, velocity=velocity)
+
+    def silence_messages(self):
+        """the messages that stop the notes that are sounding"""
+        for channel, note in self.notes:
+            yield mido.Message('note_off', channel=channel, note=note)
+
+    def undo_messages(self, target, default_program=0):
+        """
+        the messages that undo the program, controller and pitch changes in
+        this state that aren't in the target state, i.e. when seeking back to
+        before they were made
+        """
+        for channel in self.programs.keys() - target.programs.keys():
+            yield mido.Message('program_change', channel=channel, program=default_program)
+        for channel in set(channel for channel, control in self.controls.keys() - target.controls.keys()):
+            yield mido.Message('control_change', channel=channel, control=121, value=0)
+        for channel in self.pitch.keys() - target.pitch.keys():
+            yield mido.Message('pitchwheel', channel=channel, pitch=0)
+
+
+class MidiFileEvents:
+    """
+    The messages of a midi file, with the tracks merged into one list sorted
+    by time, so that playback only has to walk it, and can seek to any
+    time by bisecting the times. Times are absolute, in seconds from the start
+    of the file, with the tempo changes already applied; meta messages are
+    dropped, since there's nothing to send for them.
+
+    Messages are kept as their raw bytes, which is all the channel state needs;
+    a mido message is only built for each message as it's sent.
+
+    The list can be filled in while it's playing (see MidiFilePlayer.load);
+    complete is set once all of the file has been added.
+    """
+    def __init__(self):
+        self.complete = False
+        self.times = array('d')
+        self.messages = list()
+        # the channel state before every SNAPSHOT_INTERVAL'th message
+        self.snapshots = list()
+        self.state = MidiChannelState()
+
+    def append(self, time_elapsed, data):
+        if len(self.messages) % SNAPSHOT_INTERVAL == 0:
+            self.snapshots.append(self.state.copy())
+        self.times.append(time_elapsed)
+        self.messages.append(data)
+        self.state.update(data)
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def duration(self):
+        return self.times[-1] if self.times else 0
+
+    def index_at(self, time_elapsed):
+        """the index of the first message at or after time_elapsed"""
+        return bisect_left(self.times, time_elapsed)
+
+    def state_at(self, index):
+        """the channel state just before the message at index"""
+        snapshot = min(index // SNAPSHOT_INTERVAL, len(self.snapshots) - 1)
+        if snapshot < 0:
+            return MidiChannelState()
+        state = self.snapshots[snapshot].copy()
+        for data in self.messages[snapshot * SNAPSHOT_INTERVAL:index]:
+            state.update(data)
+        return state
+
+
+class PlaybackStream:
+    """
+    A stream of timed events for a PlaybackScheduler to play, i.e. a tune or
+    a midi file. A stream says when its next event is due and plays the events
+    that are due when asked; it's the scheduler that does the waiting, so any
+    number of streams can play in sync without a thread each.
+
+    The scheduler's lock guards the state of all of its streams, so that the
+    methods that control a stream can be called from any thread.
+    """
+    def __init__(self, scheduler, channel=0):
+        self.scheduler = scheduler
+        self.condition = scheduler.condition
+        # the midi channel the stream plays on, for streams that don't have
+        # channels of their own
+        self.channel = channel
+        self.muted = False
+        self.stopped = False
+        # called with the stream on the scheduler thread once it's done
+        self.on_finish = None
+        # how late each event was played
+        self.lateness = LatencyStats()
+
+    def start(self, now):
+        """called by the scheduler when the stream starts playing at now"""
+
+    def deadline(self):
+        """the perf_counter time the next event is due, or None if none is"""
+        return None
+
+    def play_due(self, now, audible):
+        """play the events that are due by now; without sound if not audible"""
+
+    def done(self):
+        return self.stopped
+
+    def finish(self):
+        """called on the scheduler thread, without the lock, once it's done"""
+        if self.on_finish:
+            self.on_finish(self)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def toggle_mute(self):
+        with self.condition:
+            self.muted = not self.muted
+
+
+class PlaybackScheduler:
+    """
+    Plays any number of PlaybackStreams on one thread and one clock; streams
+    added together start on the same clock tick, so i.e. the left and right
+    hand of a tune stay in sync, and their events are sent in time order
+    instead of by threads racing each other for the output port.
+
+    Events are played against absolute perf_counter deadlines, so oversleeping
+    and the time taken to play each event don't accumulate. When spin is set,
+    the scheduler busy waits for the last SPIN_THRESHOLD before a deadline,
+    since sleeping is only accurate to around a millisecond.
+
+    A stream can be muted, or soloed so that only it is heard; muted streams
+    keep playing silently, so they stay in sync if they're unmuted.
+    """
+    def __init__(self, spin=False):
+        self.spin = spin
+        self.streams = list()
+        self.solo = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='piano playback', daemon=True)
+        self.thread.start()
+
+    def add(self, *streams):
+        """start playing the streams, all from the same moment"""
+        with self.condition:
+            now = time.perf_counter()
+            for stream in streams:
+                stream.start(now)
+                self.streams.append(stream)
+            self.condition.notify_all()
+
+    def audible(self, stream):
+        return not stream.muted and (self.solo is None or self.solo is stream)
+
+    def toggle_solo(self, stream):
+        with self.condition:
+            self.solo = None if self.solo is stream else stream
+
+    def stop(self):
+        """stop all of the streams, and the scheduler once they've finished"""
+        with self.condition:
+            self.stopped = True
+            for stream in self.streams:
+                stream.stopped = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                finished = [stream for stream in self.streams if stream.done()]
+                for stream in finished:
+                    self.streams.remove(stream)
+                    if self.solo is stream:
+                        self.solo = None
+                if not finished:
+                    if self.stopped and not self.streams:
+                        return
+                    self.play_next()
+                    continue
+
+            for stream in finished:
+                try:
+                    stream.finish()
+                except Exception as error:
+                    print('piano: error finishing playback:', error)
+
+    def play_next(self):
+        """wait for the next deadline, and play everything due by then"""
+        deadlines = [(deadline, stream) for deadline, stream in ((stream.deadline(), stream) for stream in self.streams) if deadline is not None]
+        if not deadlines:
+            self.condition.wait()
+            return
+
+        deadline = min(deadline for deadline, stream in deadlines)
+        remaining = deadline - time.perf_counter()
+        if self.spin:
+            remaining -= SPIN_THRESHOLD
+        if remaining > 0:
+            # wake up early if a stream is added, paused, seeked, etc
+            self.condition.wait(remaining)
+            return
+        if self.spin and time.perf_counter() < deadline:
+            # NOTE: spin without holding the lock, so streams can still be
+            #       paused, seeked or added meanwhile; since they may have
+            #       been, the deadlines are worked out again afterwards
+            self.condition.release()
+            try:
+                while time.perf_counter() < deadline:
+                    pass
+            finally:
+                self.condition.acquire()
+            return
+
+        now = time.perf_counter()
+        for deadline, stream in sorted(deadlines, key=lambda item: item[0]):
+            if deadline <= now:
+                try:
+                    stream.play_due(now, self.audible(stream))
+                except Exception as error:
+                    # NOTE: only this stream stops; run finishes it on the next pass
+                    print('piano: error playing stream:', error)
+                    stream.stopped = True
+                    continue
+                stream.lateness.add(now - deadline)
+
+
+class MidiFilePlayer(PlaybackStream):
+    """
+    Plays MidiFileEvents to a send function as a stream of a PlaybackScheduler;
+    the other methods can be called from any thread to pause, resume, seek or
+    change the speed while it plays.
+
+    The position in the file is worked out from perf_counter, relative to the
+    file time and clock time it was last rebased at (when playback started, or
+    was paused, seeked or had its speed changed), so none of these accumulate
+    any drift. The notes that are sounding, and the program and controllers of
+    each channel, are tracked as messages are sent, so that pausing can stop
+    the notes and resuming or seeking can bring the output port back to the
+    right state.
+    """
+    def __init__(self, scheduler, events, send, speed=1.0, default_program=0):
+        super().__init__(scheduler)
+        self.events = events
+        self.send = send
+        # the program of a channel before the file sets one
+        self.default_program = default_program
+        self.speed = speed
+        self.index = 0
+        self.state = MidiChannelState()
+        self.paused = False
+        # the file time, in seconds, at the clock time it was rebased at
+        self.base_time = 0
+        self.base_clock = time.perf_counter()
+        # the exception that stopped the events from loading, if any
+        self.load_error = None
+
+    def position(self, now=None):
+        """the current time in the file, in seconds"""
+        if self.paused:
+            return self.base_time
+        if now is None:
+            now = time.perf_counter()
+        return self.base_time + (now - self.base_clock) * self.speed
+
+    def rebase(self, time_elapsed, now=None):
+        self.base_time = time_elapsed
+        self.base_clock = time.perf_counter() if now is None else now
+
+    def send_all(self, messages):
+        for msg in messages:
+            self.send(msg)
+
+    def start(self, now):
+        self.rebase(self.base_time, now)
+
+    def deadline(self):
+        if self.paused or self.index >= len(self.events):
+            # paused, or waiting for more of the file to load
+            return None
+        return self.base_clock + (self.events.times[self.index] - self.base_time) / self.speed
+
+    def done(self):
+        return self.stopped or (self.events.complete and self.index >= len(self.events))
+
+    def play_due(self, now, audible):
+        # send everything that's due, so a chord goes out together
+        end = max(bisect_right(self.events.times, self.position(now), self.index), self.index + 1)
+        for data in self.events.messages[self.index:end]:
+            # NOTE: a muted stream still sends everything but its note_ons
+            if audible or data[0] & 0xF0 != 0x90:
+                self.send(mido.Message.from_bytes(data))
+            self.state.update(data)
+        self.index = end
+
+    def load(self, messages, batch_size=64, max_batch_size=4096):
+        """
+        Add (seconds, message bytes) pairs to the events as they're decoded,
+        while the scheduler plays them; the first batch is small so playback
+        can start straight away, and later ones get bigger to take the lock
+        less often. Stops early if playback is stopped.
+        """
+        batch = list()
+        try:
+            for item in messages:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not self.add_events(batch):
+                        return
+                    batch = list()
+                    batch_size = min(batch_size * 2, max_batch_size)
+            self.add_events(batch)
+        except Exception as error:
+            self.load_error = error
+        finally:
+            with self.condition:
+                self.events.complete = True
+                self.condition.notify_all()
+
+    def add_events(self, batch):
+        with self.condition:
+            if self.stopped:
+                return False
+            for time_elapsed, data in batch:
+                self.events.append(time_elapsed, data)
+            self.condition.notify_all()
+        return True
+
+    def pause(self):
+        with self.condition:
+            if self.paused or self.stopped:
+                return
+            self.base_time = self.position()
+            self.paused = True
+            self.send_all(self.state.silence_messages())
+            self.condition.notify_all()
+
+    def resume(self):
+        with self.condition:
+            if not self.paused:
+                return
+            self.send_all(self.state.restore_messages())
+            self.rebase(self.base_time)
+            self.paused = False
+            self.condition.notify_all()
+
+    def toggle_pause(self):
+        if self.paused:
+            self.resume()
+        else:
+            self.pause()
+
+    def seek(self, time_elapsed):
+        """continue playback from time_elapsed seconds into the file"""
+        with self.condition:
+            time_elapsed = max(0, min(time_elapsed, self.events.duration))
+            self.send_all(self.state.silence_messages())
+            self.index = self.events.index_at(time_elapsed)
+            state = self.events.state_at(self.index)
+            self.send_all(self.state.undo_messages(state, self.default_program))
+            # NOTE: the target state's notes are sounded by restore_messages;
+            #       until then, the current state has no notes sounding
+            self.state = state
+            if self.paused:
+                # the notes get sounded when playback resumes
+                self.base_time = time_elapsed
+            else:
+                self.send_all(self.state.restore_messages())
+                self.rebase(time_elapsed)
+            self.condition.notify_all()
+
+    def set_speed(self, speed):
+        with self.condition:
+            self.rebase(self.position())
+            self.speed = max(0.01, speed)
+            self.condition.notify_all()
+
+
+class NoteOffScheduler:
+    """
+    Runs callbacks (i.e. note offs) after a delay, on a thread of its own, so
+    they happen on time however busy the editor is.
+
+    Each timer has a key, so it can be cancelled, or extended while it's still
+    pending (i.e. while a key is held and repeating), without having to find
+    it in the queue; the timers are in a heap by deadline, and a heap entry is
+    just skipped if its timer has since been cancelled or replaced, or put
+    back with the later deadline if its timer has been extended.
+    """
+    def __init__(self):
+        # the pending timers by key; each is a list of [deadline, callback]
+        self.timers = dict()
+        self.queue = list()
+        self.order = count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='piano note off scheduler', daemon=True)
+        self.thread.start()
+
+    def schedule(self, key, delay, callback):
+        """call callback delay ms from now, replacing any timer with the same key"""
+        timer = [time.perf_counter() + delay / 1000, callback]
+        with self.condition:
+            self.timers[key] = timer
+            self.push(key, timer)
+
+    def extend(self, key, delay):
+        """
+        Make the timer with key go off no sooner than delay ms from now;
+        returns False if there is no such timer, i.e. it already went off.
+        """
+        deadline = time.perf_counter() + delay / 1000
+        with self.condition:
+            timer = self.timers.get(key)
+            if timer is None:
+                return False
+            if deadline > timer[0]:
+                # the heap entry gets moved when it comes up
+                timer[0] = deadline
+            return True
+
+    def cancel(self, key):
+        """cancel the timer with key, returning whether it was still pending"""
+        with self.condition:
+            return self.timers.pop(key, None) is not None
+
+    def push(self, key, timer):
+        heappush(self.queue, (timer[0], next(self.order), key, timer))
+        if self.queue[0][3] is timer:
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.timers.clear()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    deadline, _, key, timer = self.queue[0]
+                    if self.timers.get(key) is not timer:
+                        # cancelled or replaced
+                        heappop(self.queue)
+                        continue
+                    if timer[0] > deadline:
+                        # extended
+                        heappop(self.queue)
+                        self.push(key, timer)
+                        continue
+                    remaining = deadline - time.perf_counter()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                        continue
+                    heappop(self.queue)
+                    del self.timers[key]
+                    break
+
+            # NOTE: the callback is called without the lock held, so that it
+            #       can schedule more timers
+            try:
+                timer[1]()
+            except Exception as error:
+                print('piano: error in a scheduled note off:', error)
@@ -2,13 +2,17 @@ import sublime, sublime_plugin
 import mido
 import mimetypes
 import time
-from typing import Iterable
-from collections import deque
 import itertools
+from collections import Counter
 import threading
-from os import path
-from urllib.request import urlopen
+from os import path, makedirs
+import re
 from . import piano_tunes
+from . import piano_playback
+from . import piano_tune_cache
+from . import piano_smf
+from . import piano_layouts
+from . import piano_midi_output
 
 
 ### ---------------------------------------------------------------------------
@@ -17,6 +21,53 @@ from . import piano_tunes
 in_port = None
 out_port = None
 
+# Sends notes to out_port as raw bytes, without building mido messages
+raw_out = None
+
+# The on disk cache of compiled piano tunes, shared by playback and export
+compiled_tune_cache = None
+
+# Turns off notes that are played for a set time (clicked keys, held pc
+# keyboard keys), on a thread of its own so they stop on time
+note_off_scheduler = None
+
+# Plays all piano-tunes and midi files on one thread and one clock, so that
+# everything playing at once stays in sync
+playback_scheduler = None
+
+# The midi channels that piano-tunes played together are put on; channel 10
+# (9 counting from 0) is for percussion in General MIDI, so it's left out
+PIANO_TUNE_CHANNELS = [channel for channel in range(16) if channel != 9]
+
+# Pulls the note index out of the scope of a key in a piano layout
+KEY_SCOPE_RE = re.compile(r'\.midi-(\d+)\.')
+
+# The Piano listeners for all of the open piano views, keyed by view id. The
+# listeners add themselves here when they're created and remove themselves
+# when the view closes, so that the hot paths (playing notes, midi input) can
+# find the piano without looking through every view in every window.
+piano_listeners = dict()
+
+# The Piano listener of the piano view that has the focus, if any; incoming
+# midi is only handled while the piano has the focus.
+focused_piano = None
+
+# The types of incoming midi message to drop without sending them on, from the
+# midi_input_ignore_types setting.
+midi_input_ignore_types = set()
+
+# How long each input path (the pc keyboard, clicking on the piano, incoming
+# midi) takes to reach each stage: the note_on call, the note being sent to
+# the output port and the key being drawn on the piano.
+input_latency = piano_playback.LatencyRecorder()
+
+# The region keys used to draw all lit keys at once, per colour scope, when
+# the piano display is rendering in batched mode.
+BATCHED_REGION_KEYS = {
+    'meta.piano-playing': 'piano-midi-notes',
+    'meta.piano-playing-but-no-out-port': 'piano-midi-notes-no-out-port',
+}
+
 
 ### ---------------------------------------------------------------------------
 
@@ -29,20 +80,49 @@ def plugin_loaded():
         "program": None,
 
         "piano_update_fps": 20,
+        "piano_batched_render": True,
 
         "piano_layout": "piano_7octave",
+        "piano_layout_ranges": [[24, 59], [36, 83], [21, 108]],
 
         # TODO: In the code, this was region.redish, but in the settings file
         # it's string; which is the one we want?
         "scope_to_highlight_current_piano_tune_note": "string",
+
+        "piano_tune_playback_spin_wait": False,
+
+        "midi_input_ignore_types": [],
+
+        "compiled_piano_tune_cache_size_mb": 64,
     }
 
+    global note_off_scheduler
+    note_off_scheduler = piano_playback.NoteOffScheduler()
+
+    global playback_scheduler
+    playback_scheduler = piano_playback.PlaybackScheduler()
+
+    global compiled_tune_cache
+    compiled_tune_cache = piano_tune_cache.CompiledTuneCache(
+        path.join(sublime.cache_path(), __name__.split('.')[0], 'compiled-tunes'),
+        piano_prefs('compiled_piano_tune_cache_size_mb') * 1024 * 1024
+    )
+
+    # NOTE: this is checked for every incoming midi message, so rather than
+    #       asking the settings each time, keep a copy that follows changes
+    piano_prefs.obj.add_on_change('piano_plugin', midi_input_settings_changed)
+    midi_input_settings_changed()
+
     port_changed('in', piano_prefs('input_name'))
     port_changed('out', piano_prefs('output_name'))
 
 
 def plugin_unloaded():
-    PlayMidiFileCommand.midi = None
+    piano_prefs.obj.clear_on_change('piano_plugin')
+    if playback_scheduler:
+        playback_scheduler.stop()
+    if note_off_scheduler:
+        note_off_scheduler.stop()
     port_changed('in', None)
     port_changed('out', None)
 
@@ -74,11 +154,14 @@ def get_available_port_names(port_type):
 def port_changed(port_type, port_name):
     global in_port
     global out_port
+    global raw_out
 
     if port_type == 'out':
         if out_port:
             out_port.reset()
             out_port.close()
+            out_port = None
+            raw_out = None
             reset_piano_regions(get_piano_view())
     elif port_type == 'in':
         if in_port:
@@ -102,6 +185,7 @@ def port_changed(port_type, port_name):
 
     if port_type == 'out':
         out_port = mido.open_output(port_name)
+        raw_out = piano_midi_output.RawMidiOutput(out_port)
         program_changed(piano_prefs('program'))
     elif port_type == 'in':
         in_port = mido.open_input(port_name, callback=handle_midi_input)
@@ -114,71 +198,133 @@ def program_changed(program, save=False):
     if save:
         piano_prefs("program", program)
 
-    msg = mido.Message('program_change', program=program)
-    out_port.send(msg)
+    if out_port:
+        msg = mido.Message('program_change', program=program)
+        out_port.send(msg)
+
+
+def midi_input_settings_changed():
+    global midi_input_ignore_types
+    midi_input_ignore_types = set(piano_prefs('midi_input_ignore_types') or [])
 
 
 def handle_midi_input(msg):
-    # Only handle the message if the piano has the focus; could also find the
-    # piano view in the window as the other command does. Note: there is not
-    # always an active view.
-    view = sublime.active_window().active_view()
-    if not view:
-        return
+    """
+    Called by mido on its own thread for every incoming message; this needs to
+    be quick, so it sends the message on straight away and only hands the note
+    changes to the piano's display driver, which draws them once per frame.
+    """
+    origin = input_latency.origin('midi_input')
 
-    listener = sublime_plugin.find_view_event_listener(view, Piano)
-    if listener:
-        # Ship the message over; this will play notes, but also allow for
-        # program changes, etc. This lets incoming velocity and aftertouch
-        # information through without the event listener needing to  synthesize
-        # them
+    # Only handle the message if the piano has the focus; the focused piano is
+    # tracked by the listener, so that there's no need to ask for the active
+    # view here.
+    listener = focused_piano
+    if not listener:
+        return False
+
+    # Drop the types of message that the user doesn't want, i.e. aftertouch
+    if msg.type in midi_input_ignore_types:
+        return True
+
+    # Ship the message over; this will play notes, but also allow for
+    # program changes, etc. This lets incoming velocity and aftertouch
+    # information through without the event listener needing to  synthesize
+    # them
+    if out_port:
         out_port.send(msg)
+        input_latency.record(origin, 'send')
 
-        # For note messges, we want to synthesize the display.
-        if msg.type.startswith('note_'):
-            octave, note = PianoMidi.midi_note_to_note(msg.note)
+    # For note messges, we want to synthesize the display. Per the specs,
+    # note_on with a velocity of 0 should be interpreted as note_off.
+    if msg.type == 'note_on' or msg.type == 'note_off':
+        octave, note = PianoMidi.midi_note_to_note(msg.note)
+        listener.driver.note(octave, note, msg.type == 'note_on' and msg.velocity > 0, origin)
 
-            # Per the specs, note_on with a velocity of 0 should be interpreted
-            # as note_off; if that happens replace the message so the display
-            # will update.
-            if msg.type == 'note_on' and msg.velocity == 0:
-                msg = mido.Message('note_off', note=msg.note, time=msg.time)
+    return True
 
-            # Get the listener to update the display but not play the note.
-            sublime.set_timeout(lambda: getattr(listener, msg.type)(octave, note, False))
 
-        return True
+def send_midi_file_message(msg):
+    """
+    Called by the midi file player for every message it plays; the message
+    goes straight to the output port, and notes are shown on the piano.
+    """
+    if msg.type in midi_input_ignore_types:
+        return
 
-    return False
+    if out_port:
+        out_port.send(msg)
+
+    if msg.type == 'note_on' or msg.type == 'note_off':
+        listener = find_piano_listener()
+        if listener:
+            octave, note = PianoMidi.midi_note_to_note(msg.note)
+            listener.driver.note(octave, note, msg.type == 'note_on' and msg.velocity > 0)
 
 
 def set_piano_layout(piano_view, piano_layout):
-    try:
-        layout = sublime.load_resource(get_res_name('data/%s.piano_layout' % piano_layout))
-        layout = layout.replace('\r\n', '\n').replace('\r', '\n')
-    except:
-        piano_view.window().status_message("Unable to find piano layout '%s'" % piano_layout)
-        return False
-    piano_start_pos = layout.find('┌')
-    meta_data = layout[0:piano_start_pos].splitlines()
-    layout = layout[piano_start_pos:]
+    # Generated layouts (i.e. piano_keys_36-83) are drawn on the fly, rather
+    # than loaded from a resource.
+    generated = piano_layouts.piano_layout(piano_layout)
+    if generated:
+        layout = generated.text
+        meta_data = generated.settings.items()
+    else:
+        try:
+            layout = sublime.load_resource(get_res_name('data/%s.piano_layout' % piano_layout))
+            layout = layout.replace('\r\n', '\n').replace('\r', '\n')
+        except:
+            piano_view.window().status_message("Unable to find piano layout '%s'" % piano_layout)
+            return False
+        piano_start_pos = layout.find('┌')
+        meta_data = [line.split(':') for line in layout[0:piano_start_pos].splitlines()]
+        layout = layout[piano_start_pos:]
 
     piano_view.set_read_only(False)
-    piano_view.run_command('select_all')
-    piano_view.run_command('left_delete')
-    piano_view.run_command('append', {'characters': layout, 'disable_tab_translation': True})
+    piano_view.run_command('replace_piano_layout', {'layout': layout})
     piano_view.set_read_only(True)
 
+    # The keys are now in different places, so the key index needs rebuilding.
+    listener = find_piano_listener(piano_view)
+    if listener:
+        listener.driver.invalidate_key_regions()
+
     # Save the layout used for later.
     piano_view.settings().set('piano_layout', piano_layout)
     piano_view.settings().erase('start_octave')
-    for line in meta_data:
-        key, value = line.split(':')
+    for key, value in meta_data:
         piano_view.settings().set(key, value.strip())
 
     return True
 
 
+def compile_piano_tune_view(view):
+    """
+    Return the whole piano tune in the view as a CompiledTune, from the compiled
+    tune cache if the tune hasn't changed since it was last compiled.
+    """
+    def compile_tune():
+        tokens = piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(view, [sublime.Region(0, view.size())]))
+        return piano_tunes.compile_piano_tune(tokens)
+
+    return compiled_tune_cache.compile(view.substr(sublime.Region(0, view.size())), compile_tune)
+
+
+def find_piano_listener(view=None):
+    """
+    Return the Piano listener for the given view, or for any open piano view
+    if no view is given; None if there isn't one.
+    """
+    if view is not None:
+        return piano_listeners.get(view.id())
+
+    for view_id, listener in list(piano_listeners.items()):
+        if listener.view.is_valid():
+            return listener
+        piano_listeners.pop(view_id, None)
+    return None
+
+
 def get_piano_view(create=False, focus=False, piano_layout=None):
     """
     Find and return the piano view, if any. If there's not a view but create
@@ -190,12 +336,16 @@ def get_piano_view(create=False, focus=False, piano_layout=None):
     a view and piano_layout is given, then the layout is swapped to the new one
     prior to return.
     """
-    piano_view = None
-    for window in sublime.windows():
-        for view in window.views():
-            if view.name() == 'Piano':
-                piano_view = view
-                break
+    listener = find_piano_listener()
+    piano_view = listener.view if listener else None
+
+    # The piano might not have its listener yet, i.e. if it was only just created
+    if not piano_view:
+        for window in sublime.windows():
+            for view in window.views():
+                if view.name() == 'Piano':
+                    piano_view = view
+                    break
 
     # If there's a view and we also got a layout, then change it
     if piano_view and piano_layout:
@@ -232,6 +382,8 @@ def reset_piano_regions(piano_view):
         for octave in range(1,9):
             for note in range(1, 13):
                 piano_view.erase_regions('piano-midi-note-%d-%d' % (octave, note))
+        for region_key in BATCHED_REGION_KEYS.values():
+            piano_view.erase_regions(region_key)
 
 
 ### ---------------------------------------------------------------------------
@@ -244,13 +396,24 @@ class ShowPianoCommand(sublime_plugin.ApplicationCommand):
 
 
 class PlayPianoNotesCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
+    def run(self, edit, from_cursor=False):
         listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
         # take the notes from the selection or entire buffer
         regions = self.view.sel()
-        if len(regions) == 1 and regions[0].empty():
-            regions = [sublime.Region(0, self.view.size())]
-        # TODO: when playing a selection, should it automatically find the octave and tempo, from before the selection, or expect the user to select those too?
+        if from_cursor or (len(regions) == 1 and regions[0].empty()):
+            tune = compile_piano_tune_view(self.view)
+            listener.play_tune(tune, offset=regions[0].begin() if from_cursor else None)
+            return
+        # when playing a selection, start with the octave, tempo and length from
+        # before the selection, resolved from the nearest checkpoint, and the
+        # labels of the whole tune
+        _, resolver = listener.resolve_up_to(regions[0].begin())
+        start_state = resolver.checkpoint(regions[0].begin())
+        if start_state:
+            start_state = start_state._replace(
+                state=start_state.state._replace(time_elapsed=0, duration=0, instruction=None),
+                max_time_elapsed=0
+            )
         # TODO: think about how left hand vs right hand vs both hand playing could work
         #       - should they be in separate files, or marked up in a single file?
         #         - maybe easier to understand the files if separate, especially with labels etc.
@@ -259,13 +422,10 @@ class PlayPianoNotesCommand(sublime_plugin.TextCommand):
         #         - here the left and right hand (i.e. if user is playing right hand and left is on auto-play) need to stay synced up
         tokens = piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, regions))
         #print(list(tokens))
-        states = piano_tunes.resolve_piano_tune_instructions(tokens)
+        tune = piano_tunes.CompiledTune()
+        piano_tunes.TuneResolver(checkpoint=start_state).resolve(tokens, states=tune)
 
-        midi_messages = piano_tunes.convert_piano_tune_to_midi(states)
-        #from pprint import pprint
-        #midi_messages = list(midi_messages); pprint(midi_messages)
-
-        listener.play_midi_instructions(midi_messages)
+        listener.play_tune(tune.finish())
 
     def is_enabled(self):
         listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
@@ -275,11 +435,106 @@ class PlayPianoNotesCommand(sublime_plugin.TextCommand):
 class StopPianoNotesCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
-        listener.playback_stopped = True
+        listener.playback.stop()
 
     def is_enabled(self):
         listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
-        return listener is not None and not listener.playback_stopped
+        return listener is not None and listener.playback is not None
+
+
+class PlayAllPianoTunesCommand(sublime_plugin.WindowCommand):
+    """
+    Play the piano-tunes in all of the views in the window together, in sync,
+    each on a midi channel of its own; i.e. for the left and right hand parts
+    of a tune in separate files.
+    """
+    def run(self):
+        streams = list()
+        for view, listener in self.listeners():
+            if listener.playback is None:
+                channel = PIANO_TUNE_CHANNELS[len(streams) % len(PIANO_TUNE_CHANNELS)]
+                streams.append(listener.playback_stream(compile_piano_tune_view(view), channel))
+        playback_scheduler.spin = piano_prefs('piano_tune_playback_spin_wait')
+        playback_scheduler.add(*streams)
+
+    def listeners(self):
+        for view in self.window.views():
+            listener = sublime_plugin.find_view_event_listener(view, PianoTune)
+            if listener:
+                yield view, listener
+
+    def is_enabled(self):
+        return any(listener.playback is None for view, listener in self.listeners())
+
+
+class MutePianoTuneCommand(sublime_plugin.TextCommand):
+    """
+    Mute or unmute the piano-tune playing in this view; it carries on playing
+    silently, so it stays in sync with anything else that's playing.
+    """
+    def run(self, edit):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        listener.playback.toggle_mute()
+
+    def is_checked(self):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        return listener is not None and listener.playback is not None and listener.playback.muted
+
+    def is_enabled(self):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        return listener is not None and listener.playback is not None
+
+
+class SoloPianoTuneCommand(MutePianoTuneCommand):
+    """
+    Make the piano-tune playing in this view the only one that's heard, or go
+    back to hearing everything.
+    """
+    def run(self, edit):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        playback_scheduler.toggle_solo(listener.playback)
+
+    def is_checked(self):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        return listener is not None and listener.playback is not None and playback_scheduler.solo is listener.playback
+
+
+class PianoTuneTransportCommand(sublime_plugin.TextCommand):
+    """
+    Control the piano-tune playing in this view; pause and resume it, seek
+    seek seconds into the tune (or skip seconds forward or back from where it
+    is), or to the instruction at the cursor, loop the instructions in the
+    selection (or stop looping when loop is false), play it at a different
+    speed, where 1 is normal speed, or transpose it by a number of semitones
+    (or transpose_by semitones from where it is now).
+    """
+    def run(self, edit, pause=False, seek=None, skip=None, seek_to_cursor=False, loop=None, speed=None, transpose=None, transpose_by=None):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        playback = listener.playback
+        if pause:
+            playback.toggle_pause()
+        if seek is not None:
+            playback.seek(seek * 1000)
+        if skip is not None:
+            playback.seek(playback.position() + skip * 1000)
+        if seek_to_cursor:
+            playback.seek_to_offset(self.view.sel()[0].begin())
+        if loop is not None:
+            region = self.view.sel()[0]
+            if loop and not region.empty():
+                playback.loop_offsets(region.begin(), region.end())
+            else:
+                playback.set_loop()
+        if speed is not None:
+            playback.set_speed(speed)
+        if transpose_by is not None:
+            transpose = playback.transpose + transpose_by
+        if transpose is not None:
+            playback.set_transpose(transpose)
+
+    def is_enabled(self, **kwargs):
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        return listener is not None and listener.playback is not None
 
 
 class ResetMidiPortCommand(sublime_plugin.ApplicationCommand):
@@ -308,21 +563,31 @@ class ConvertPianoTuneNotationCommand(sublime_plugin.TextCommand):
         if len(regions) == 1 and regions[0].empty():
             regions = [sublime.Region(0, self.view.size())]
 
-        tokens = list(token for token in piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, regions)) if isinstance(token, piano_tunes.NoteInstruction))
-        if not tokens:
+        # NOTE: the notes of each region are kept separate, so that each
+        #       region can be converted with a single replacement
+        region_tokens = list()
+        for region in regions:
+            tokens = list(token for token in piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, [region])) if isinstance(token, piano_tunes.NoteInstruction))
+            if tokens:
+                region_tokens.append((region, tokens))
+        if not region_tokens:
             # no notes to convert
             return
 
         if convert_to == 'toggle_notation':
-            convert_to = 'solfege' if self.view.substr(tokens[0].span).lower() in PianoMidi.notes_letters else 'letter'
+            first_token = region_tokens[0][1][0]
+            convert_to = 'solfege' if self.view.substr(first_token.span).lower() in PianoMidi.notes_letters else 'letter'
         to_notes = PianoMidi.notes_letters if convert_to == 'letter' else PianoMidi.notes_solfege
 
         if keep_spacing == 'auto':
             keep_spacing = self.view.settings().get('is_piano', False)
             if keep_spacing:
                 self.view.set_read_only(False)
-        for token in reversed(tokens):
-            if isinstance(token, piano_tunes.NoteInstruction):
+        # work backwards, so that replacing a region doesn't move the ones
+        # that are still to be converted
+        for region, tokens in reversed(region_tokens):
+            replacements = list()
+            for token in tokens:
                 replace_with = to_notes[token.value]
                 if len(replace_with) > token.span.size() and keep_spacing:
                     # the difference should always be 1... but I'm not hard coding it
@@ -334,8 +599,23 @@ class ConvertPianoTuneNotationCommand(sublime_plugin.TextCommand):
                     replace_span = token.span
                     if keep_spacing:
                         replace_with = replace_with.ljust(token.span.size())
-
-                self.view.replace(edit, replace_span, replace_with)
+                replacements.append((replace_span, replace_with))
+
+            # build the converted text of the whole region in one go, which
+            # can spill past the end of the region if the last note grew
+            begin = region.begin()
+            end = max(region.end(), replacements[-1][0].end())
+            text = self.view.substr(sublime.Region(begin, end))
+            converted = list()
+            position = begin
+            for replace_span, replace_with in replacements:
+                if replace_span.begin() > position:
+                    converted.append(text[position - begin:replace_span.begin() - begin])
+                converted.append(replace_with)
+                position = max(position, replace_span.end())
+            converted.append(text[position - begin:])
+
+            self.view.replace(edit, sublime.Region(begin, end), ''.join(converted))
         if self.view.settings().get('is_piano', False):
             self.view.set_read_only(True)
 
@@ -347,23 +627,11 @@ class ExportPianoTuneToMidiCommand(sublime_plugin.TextCommand):
     def run(self, edit, export_filepath=None):
         regions = self.view.sel()
         if len(regions) == 1 and regions[0].empty():
-            regions = [sublime.Region(0, self.view.size())]
-
-        tokens = piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, regions))
-        states = piano_tunes.resolve_piano_tune_instructions(tokens)
-        midi_messages = piano_tunes.convert_piano_tune_to_midi(states)
-
-        mid = mido.MidiFile(type=0)
-        track = mido.MidiTrack()
-        mid.tracks.append(track)
-
-        time_elapsed = 0
-        for item in midi_messages:
-            time_delta = item.time_elapsed - time_elapsed
-            msg = item.to_midi_message(time_delta)
-            if msg:
-                track.append(msg)
-                time_elapsed = item.time_elapsed
+            tune = compile_piano_tune_view(self.view)
+        else:
+            tokens = piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, regions))
+            tune = piano_tunes.compile_piano_tune(tokens)
+        mid = piano_tunes.piano_tune_to_midi_file(tune.events())
 
         if not export_filepath:
             export_filepath = path.splitext(self.view.file_name())[0] + '.mid'
@@ -377,22 +645,34 @@ class PlayMidiFileCommand(sublime_plugin.ApplicationCommand):
     current playback. If no midi file name is provided as an argument, the
     name of the current file is used instead (which needs to be a midi file).
 
+    While playing, playback can be paused and resumed, moved to seek seconds
+    into the file (or skip seconds forward or back from where it is), and
+    played at a different speed, where 1 is normal speed.
+
     Playback can't start if the command is already playing something.
     """
-    midi = None
-
-    def run(self, stop=False, midi_filename=None):
-        if stop:
-            PlayMidiFileCommand.midi = None
-            if out_port:
-                out_port.reset()
-                reset_piano_regions(get_piano_view())
-                program_changed(piano_prefs('program'))
+    player = None
+
+    def run(self, stop=False, midi_filename=None, pause=False, seek=None, skip=None, speed=None):
+        player = PlayMidiFileCommand.player
+        if player:
+            if stop:
+                player.stop()
+            if pause:
+                player.toggle_pause()
+            if seek is not None:
+                player.seek(seek)
+            if skip is not None:
+                player.seek(player.position() + skip)
+            if speed is not None:
+                player.set_speed(speed)
+            return
 
+        if stop or pause or seek is not None or skip is not None:
             return
 
         midi_filename = self.filename(midi_filename)
-        threading.Thread(target=lambda: self.play(midi_filename)).start()
+        threading.Thread(target=lambda: self.play(midi_filename, speed or 1.0)).start()
 
     def filename(self, file_name):
         if file_name:
@@ -401,45 +681,55 @@ class PlayMidiFileCommand(sublime_plugin.ApplicationCommand):
         view = sublime.active_window().active_view()
         return view.file_name() if view is not None else None
 
-    def play(self, file_name):
+    def play(self, file_name, speed):
+        # Hold the place while the file opens, so playback can't be started
+        # twice.
+        PlayMidiFileCommand.player = player = piano_playback.MidiFilePlayer(
+            playback_scheduler, piano_playback.MidiFileEvents(), send_midi_file_message, speed,
+            default_program=piano_prefs('program') or 0
+        )
+        player.on_finish = PlayMidiFileCommand.playback_finished
         try:
-            # If the incoming filename is a midi data URI, then load up the
-            # data as a file object for passing to mido; otherwise, it's
-            # expected to be a filename.
-            if file_name.startswith('data:audio/mid'):
-                with urlopen(file_name) as data_uri:
-                    midi = mido.MidiFile(file=data_uri)
-            else:
-                midi = mido.MidiFile(file_name)
-
-            PlayMidiFileCommand.midi = midi
-            for msg in PlayMidiFileCommand.midi.play():
-                if not PlayMidiFileCommand.midi:
-                    return
-
-                if not handle_midi_input(msg):
-                    out_port.send(msg)
-
-            sublime.active_window().status_message("Midi playback complete")
+            midi = piano_smf.MidiFileBuffer.open(file_name)
         except:
+            PlayMidiFileCommand.player = None
             sublime.active_window().status_message("Midi playback error")
             raise
-        finally:
-            PlayMidiFileCommand.midi = None
-            if out_port:
-                out_port.reset()
-                reset_piano_regions(get_piano_view())
-                program_changed(piano_prefs('program'))
-
-    def is_enabled(self, stop=False, midi_filename=None):
-        # If we're being asked to stop, whether we can or not is determined by
-        # whether we're playing or not.
-        if stop:
-            return PlayMidiFileCommand.midi is not None
-
-        # We can't play if playback is already started
-        if PlayMidiFileCommand.midi is not None:
-            return False
+
+        # The file (or the decoded data URI) is memory mapped, and the tracks
+        # are decoded and merged into the player's list of messages on this
+        # thread while the playback scheduler plays them, so that playback
+        # can start as soon as the first messages are in.
+        with midi:
+            playback_scheduler.spin = piano_prefs('piano_tune_playback_spin_wait')
+            playback_scheduler.add(player)
+            player.load(iter(midi))
+
+    @staticmethod
+    def playback_finished(player):
+        if player.load_error:
+            sublime.active_window().status_message("Midi playback error")
+            print('piano: error playing midi file:', repr(player.load_error))
+        elif not player.stopped:
+            sublime.active_window().status_message("Midi playback complete")
+        print('piano: midi file playback lateness', player.lateness.report())
+
+        PlayMidiFileCommand.player = None
+        if out_port:
+            out_port.reset()
+            reset_piano_regions(get_piano_view())
+            program_changed(piano_prefs('program'))
+
+    def is_enabled(self, stop=False, midi_filename=None, pause=False, seek=None, skip=None, speed=None):
+        # If we're being asked to control playback, whether we can or not is
+        # determined by whether we're playing or not.
+        if stop or pause or seek is not None or skip is not None:
+            return PlayMidiFileCommand.player is not None
+
+        # Changing the speed while playing is fine, but we can't start
+        # playing if playback is already started
+        if PlayMidiFileCommand.player is not None:
+            return speed is not None
 
         # We can only play if we got a filename that appears to be midi; this
         # can be either an actual midi file, or a data URI with a mime type
@@ -494,11 +784,54 @@ class PickMidiProgramCommand(sublime_plugin.ApplicationCommand):
         return out_port is not None
 
 
-class PlayPianoNoteFromPcKeyboardCommand(sublime_plugin.TextCommand):
-    active_notes = dict()
+class ShowPianoLatencyCommand(sublime_plugin.WindowCommand):
+    """
+    Show the latency of each input path in an output panel, along with how
+    many region API calls the piano display makes per frame; with dump, write
+    the stats to a JSON file instead (by default in the package's cache
+    folder) so they can be compared between machines or settings. reset
+    clears the stats, to start measuring afresh.
+    """
+    def run(self, dump=False, file_name=None, reset=False):
+        listener = find_piano_listener()
+        if reset:
+            input_latency.reset()
+            if listener:
+                listener.driver.reset_render_stats()
+            self.window.status_message('piano: latency stats reset')
+            return
+
+        if dump:
+            if not file_name:
+                file_name = path.join(sublime.cache_path(), __name__.split('.')[0], 'latency.json')
+            makedirs(path.dirname(file_name), exist_ok=True)
+            data = {
+                'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'output_name': piano_prefs('output_name'),
+                'piano_update_fps': piano_prefs('piano_update_fps'),
+                'piano_batched_render': piano_prefs('piano_batched_render'),
+                'paths': input_latency.stats(),
+                'render': listener.driver.render_stats() if listener else None,
+            }
+            with open(file_name, 'w') as f:
+                f.write(sublime.encode_value(data, True))
+            self.window.status_message('piano: latency stats written to ' + file_name)
+            return
+
+        report = input_latency.report()
+        if listener:
+            report += '\nrender ({batched}): {frames_rendered} frames, {api_calls_total} region API calls, {api_calls_per_frame:.2f} per frame, {api_calls_last_frame} in the last frame'.format(
+                **dict(listener.driver.render_stats(), batched='batched' if listener.driver.batched else 'per key')
+            )
+        panel = self.window.create_output_panel('piano_latency')
+        panel.run_command('append', {'characters': report + '\n'})
+        self.window.run_command('show_panel', {'panel': 'output.piano_latency'})
 
+
+class PlayPianoNoteFromPcKeyboardCommand(sublime_plugin.TextCommand):
     def run(self, edit, character):
-        listener = sublime_plugin.find_view_event_listener(self.view, Piano)
+        origin = input_latency.origin('pc_keyboard')
+        listener = find_piano_listener(self.view)
 
         try:
             index = piano_prefs('keyboard_keys').index(character)
@@ -514,24 +847,17 @@ class PlayPianoNoteFromPcKeyboardCommand(sublime_plugin.TextCommand):
 
         note = (octave, note_index)
         # if the note is already playing, just extend the time out rather than playing it again
-        if note in self.active_notes.keys():
-            self.active_notes[note] += 1
-            timeout = 96
-        else:
-            self.active_notes[note] = 1
-            timeout = 500 # key repeat delay
-            listener.note_on(octave, note_index)
-        sublime.set_timeout_async(lambda: self.stop_or_extend_note(note), timeout)
-
-    def stop_or_extend_note(self, note):
-        self.active_notes[note] -= 1
-        if self.active_notes[note] <= 0:
-            del self.active_notes[note]
-            listener = sublime_plugin.find_view_event_listener(self.view, Piano)
+        if not note_off_scheduler.extend(('pc_keyboard', note), 96):
+            listener.note_on(octave, note_index, origin=origin)
+            note_off_scheduler.schedule(('pc_keyboard', note), 500, lambda: self.stop_note(note)) # key repeat delay
+
+    def stop_note(self, note):
+        listener = find_piano_listener(self.view)
+        if listener:
             listener.note_off(*note)
 
     def is_enabled(self):
-        return sublime_plugin.find_view_event_listener(self.view, Piano) is not None
+        return find_piano_listener(self.view) is not None
 
 
 class PickMidiPort(sublime_plugin.WindowCommand):
@@ -544,6 +870,14 @@ class PickMidiPort(sublime_plugin.WindowCommand):
             self.window.show_quick_panel(items, lambda index: port_changed(port_type, items[index] if index > -1 else None), flags=0, selected_index=pre_select_index)
 
 
+class ReplacePianoLayoutCommand(sublime_plugin.TextCommand):
+    """
+    Replace the content of the piano view with a new layout, as a single edit.
+    """
+    def run(self, edit, layout):
+        self.view.replace(edit, sublime.Region(0, self.view.size()), layout)
+
+
 class ChangePianoLayout(sublime_plugin.WindowCommand):
     def run(self, piano_layout=None):
         if piano_layout:
@@ -551,6 +885,7 @@ class ChangePianoLayout(sublime_plugin.WindowCommand):
             return
 
         items = [path.splitext(path.basename(file_path))[0] for file_path in sublime.find_resources('*.piano_layout')]
+        items += [piano_layouts.layout_name(*piano_layouts.layout_range(first, last)) for first, last in piano_prefs('piano_layout_ranges') or []]
         try:
             pre_select_index = items.index(piano_prefs('layout'))
         except ValueError:
@@ -585,18 +920,21 @@ class PianoMidi:
         octave = note // len(PianoMidi.notes_solfege)
         return (octave, note_index)
 
-    def note_on(self, octave, note_index):
-        if out_port:
-            out_port.send(mido.Message('note_on', note=PianoMidi.note_to_midi_note(octave, note_index)))
+    def note_on(self, octave, note_index, origin=None, channel=0):
+        input_latency.record(origin, 'note_on')
+        if raw_out:
+            raw_out.note(PianoMidi.note_to_midi_note(octave, note_index), True, channel)
+            input_latency.record(origin, 'send')
 
-    def play_note_with_duration(self, octave, note_index, duration):
-        self.note_on(octave, note_index)
-        # schedule the note to be turned off again
-        sublime.set_timeout_async(lambda: self.note_off(octave, note_index), duration)
+    def play_note_with_duration(self, octave, note_index, duration, origin=None):
+        self.note_on(octave, note_index, origin=origin)
+        # schedule the note to be turned off again; playing the same note
+        # again before then moves its note off, rather than adding another
+        note_off_scheduler.schedule((id(self), octave, note_index), duration, lambda: self.note_off(octave, note_index))
 
-    def note_off(self, octave, note_index):
-        if out_port:
-            out_port.send(mido.Message('note_off', note=PianoMidi.note_to_midi_note(octave, note_index)))
+    def note_off(self, octave, note_index, channel=0):
+        if raw_out:
+            raw_out.note(PianoMidi.note_to_midi_note(octave, note_index), False, channel)
 
 
 class PianoDisplayDriver:
@@ -607,13 +945,10 @@ class PianoDisplayDriver:
     def __init__(self, view):
         self.view = view
 
-        # The state of the keyboard, indexed by octave and note. False means
-        # the key is not currently pressed, True indicates that it is.
-        #
-        # TODO: Super hack; should not be hard coded, and should also properly
-        # 1-adjust the octave when requesting so the size doesn't need to be
-        # too big.
-        self.key_state = [False] * (13 * 9)
+        # The state of the keyboard, indexed by midi note. False means the key
+        # is not currently pressed, True indicates that it is. This covers the
+        # whole midi range, since generated layouts can show any of it.
+        self.key_state = [False] * (piano_layouts.MAX_NOTE + 1)
 
         # When a request is made to change the state of a key, a tuple of
         # (octave, note_index) is used to key update_request to indicate a
@@ -625,71 +960,195 @@ class PianoDisplayDriver:
         self.update_request = dict()
         self.update = 0
 
+        # The latency origins of the requests made since the last update, so
+        # the time taken for the input to be shown on the piano can be recorded
+        # once it has been drawn.
+        self.request_origins = list()
+
         # Lock the update dictionary so it can't be accessed while an update is
         # in progress.
         self.update_lock = threading.Lock()
 
         self.delay = 1000 / max(1, min(piano_prefs('piano_update_fps') or 1000, 1000))
 
+        # The regions that make up each key on the keyboard, indexed by octave
+        # and note; this is built from the layout the first time a key is drawn
+        # and invalidated whenever the layout changes.
+        self.key_regions = None
+
+        # In batched mode, every key that is lit is drawn with a single region
+        # set per colour scope, instead of one region set per key; lit_notes
+        # tracks the keys that are on, and batched_scope the scope they were
+        # last drawn with (so it can be erased if the scope changes).
+        self.batched = piano_prefs('piano_batched_render')
+        self.lit_notes = set()
+        self.batched_scope = None
+
+        # Counters for the number of add_regions/erase_regions calls made; the
+        # number of calls made in the last frame, and totals over all frames.
+        self.api_calls_last_frame = 0
+        self.api_calls_total = 0
+        self.frames_rendered = 0
+
+    def render_stats(self):
+        """the region API call counters, for ShowPianoLatencyCommand"""
+        return {
+            'batched': self.batched,
+            'frames_rendered': self.frames_rendered,
+            'api_calls_total': self.api_calls_total,
+            'api_calls_last_frame': self.api_calls_last_frame,
+            'api_calls_per_frame': self.api_calls_total / self.frames_rendered if self.frames_rendered else 0,
+        }
+
+    def reset_render_stats(self):
+        self.api_calls_last_frame = 0
+        self.api_calls_total = 0
+        self.frames_rendered = 0
+
     @staticmethod
     def region_key_for_note(octave, note_index):
         return 'piano-midi-note-' + str(octave) + '-' + str(note_index)
 
-    def get_key_region(self, octave, note_index):
+    def invalidate_key_regions(self):
+        # Called when the layout in the view changes, so that the key index is
+        # rebuilt from the new layout the next time a key is drawn.
+        self.key_regions = None
+
+    def build_key_regions(self):
+        """
+        Walk the piano layout once, and return a dictionary that maps each
+        (octave, note_index) to the list of regions (one per line) that make up
+        that key on the keyboard.
+        """
+        # generated layouts already know where their keys are
+        generated = piano_layouts.piano_layout(self.view.settings().get('piano_layout'))
+        if generated:
+            return {note: [sublime.Region(*region) for region in regions] for note, regions in generated.key_regions.items()}
+
+        key_regions = dict()
         try:
             piano_region = self.view.find_by_selector('meta.piano-instrument.piano')[0]
         except IndexError:
-            return
+            return key_regions
 
         left_most_octave = int(self.view.settings().get('start_octave', 1))
-        look_for = '.midi-' + str(note_index) + '.'
         for line in self.view.lines(piano_region):
+            tokens = self.view.extract_tokens_with_scopes(line)
+            if not tokens:
+                continue
             current_octave = left_most_octave
-            if '.midi-0.' in self.view.scope_name(line.begin()):
+            if '.midi-0.' in tokens[0][1]:
                 current_octave -= 1
-            for token in self.view.extract_tokens_with_scopes(line):
-                if not 'punctuation.' in token[1]:
-                    if look_for in token[1] and current_octave == octave:
-                        yield token[0]
-                        break
-                elif '.midi-0.' in token[1]:
+            # only the first token of each key on a line is part of the key
+            seen_on_line = set()
+            for region, scope in tokens:
+                if not 'punctuation.' in scope:
+                    match = KEY_SCOPE_RE.search(scope)
+                    if match:
+                        note = (current_octave, int(match.group(1)))
+                        if note not in seen_on_line:
+                            seen_on_line.add(note)
+                            key_regions.setdefault(note, list()).append(region)
+                elif '.midi-0.' in scope:
                     current_octave += 1
 
+        return key_regions
+
+    def get_key_regions(self, octave, note_index):
+        if self.key_regions is None:
+            self.key_regions = self.build_key_regions()
+        return self.key_regions.get((octave, note_index), [])
+
+    @staticmethod
+    def note_color_scope():
+        return 'meta.piano-playing' if out_port and not out_port.closed else 'meta.piano-playing-but-no-out-port'
+
     def draw_key_in_color(self, octave, note_index):
-        key_bounds = list(self.get_key_region(octave, note_index))
-        note_color_scope = 'meta.piano-playing' if out_port and not out_port.closed else 'meta.piano-playing-but-no-out-port'
-        self.view.add_regions(PianoDisplayDriver.region_key_for_note(octave, note_index), key_bounds, note_color_scope, '', sublime.DRAW_NO_OUTLINE)
+        key_bounds = self.get_key_regions(octave, note_index)
+        self.view.add_regions(PianoDisplayDriver.region_key_for_note(octave, note_index), key_bounds, PianoDisplayDriver.note_color_scope(), '', sublime.DRAW_NO_OUTLINE)
 
     def turn_key_color_off(self, octave, note_index):
         self.view.erase_regions(PianoDisplayDriver.region_key_for_note(octave, note_index))
 
+    def draw_lit_keys(self):
+        """
+        Draw all of the keys that are currently lit as a single region set,
+        returning the number of region API calls that were made.
+        """
+        api_calls = 0
+        scope = PianoDisplayDriver.note_color_scope()
+        if self.batched_scope is not None and self.batched_scope != scope:
+            self.view.erase_regions(BATCHED_REGION_KEYS[self.batched_scope])
+            api_calls += 1
+
+        if self.lit_notes:
+            key_bounds = list(itertools.chain.from_iterable(self.get_key_regions(*note) for note in self.lit_notes))
+            self.view.add_regions(BATCHED_REGION_KEYS[scope], key_bounds, scope, '', sublime.DRAW_NO_OUTLINE)
+            self.batched_scope = scope
+        else:
+            self.view.erase_regions(BATCHED_REGION_KEYS[scope])
+            self.batched_scope = None
+        return api_calls + 1
+
     def render(self):
         with self.update_lock:
+            changes = list()
             for note, new_state in self.update_request.items():
                 offs = PianoMidi.note_to_midi_note(*note)
                 if self.key_state[offs] != new_state:
-                    if new_state:
-                        self.draw_key_in_color(*note)
-                    else:
-                        self.turn_key_color_off(*note)
+                    changes.append((note, new_state))
                     self.key_state[offs] = new_state
 
             self.update_request.clear()
             self.update = 0
+            request_origins = self.request_origins
+            self.request_origins = list()
+
+        api_calls = 0
+        if self.batched:
+            # Only the set of lit keys matters here, so all changes made in
+            # this frame get pushed to the view together.
+            for note, new_state in changes:
+                if new_state:
+                    self.lit_notes.add(note)
+                else:
+                    self.lit_notes.discard(note)
+            if changes:
+                api_calls = self.draw_lit_keys()
+        else:
+            for note, new_state in changes:
+                if new_state:
+                    self.draw_key_in_color(*note)
+                else:
+                    self.turn_key_color_off(*note)
+                api_calls += 1
+
+        self.api_calls_last_frame = api_calls
+        self.api_calls_total += api_calls
+        self.frames_rendered += 1
 
-    def note(self, octave, note_index, note_on=True):
+        rendered = time.perf_counter()
+        for origin in request_origins:
+            input_latency.record(origin, 'render', rendered)
+
+    def note(self, octave, note_index, note_on=True, origin=None):
+        """
+        Request a key to be shown as on or off at the next update; this can be
+        called from any thread. origin is the latency origin of the input that
+        made the request, if the time until it is drawn should be recorded.
+        """
         with self.update_lock:
             self.update_request[(octave, note_index)] = note_on
+            if origin is not None:
+                self.request_origins.append(origin)
 
         if not self.update:
             self.update = 1
             sublime.set_timeout(self.render, self.delay)
 
     def reset(self):
-        # Extra large pianos have an 8 octave range and 96 keys
-        for octave in range(1,9):
-            for note in range(1, 13):
-                self.note(octave, note, False)
+        for note in range(len(self.key_state)):
+            self.note(*PianoMidi.midi_note_to_note(note), False)
 
     def is_valid(self):
         return self.view.is_valid()
@@ -706,6 +1165,22 @@ class Piano(sublime_plugin.ViewEventListener, PianoMidi):
     def __init__(self, view):
         super().__init__(view)
         self.driver = PianoDisplayDriver(view)
+        piano_listeners[view.id()] = self
+        if view == sublime.active_window().active_view():
+            self.on_activated()
+
+    def on_activated(self):
+        global focused_piano
+        focused_piano = self
+
+    def on_deactivated(self):
+        global focused_piano
+        if focused_piano is self:
+            focused_piano = None
+
+    def on_close(self):
+        self.on_deactivated()
+        piano_listeners.pop(self.view.id(), None)
 
     def on_post_text_command(self, command_name, args):
         if command_name == 'drag_select': # TODO: when clicking, keep the note playing for as long as the mouse button is pressed for
@@ -714,6 +1189,7 @@ class Piano(sublime_plugin.ViewEventListener, PianoMidi):
                     self.play_note_from_piano_at_position(sel.begin())
 
     def play_note_from_piano_at_position(self, pos):
+        origin = input_latency.origin('piano_click')
         row, col = self.view.rowcol(pos)
         if self.view.match_selector(pos, 'punctuation.section.key.piano'):
             # when the caret is on the key border line, we want to get the scope of the char to the left
@@ -730,12 +1206,12 @@ class Piano(sublime_plugin.ViewEventListener, PianoMidi):
         octave = sum(1 for token in tokens_to_the_left if '.midi-0.' in token[1]) + int(self.view.settings().get('start_octave', 1))
         if '.midi-0.' in tokens_to_the_left[0][1]:
             octave -= 1
-        self.play_note_with_duration(octave, note_index, 384)
+        self.play_note_with_duration(octave, note_index, 384, origin=origin)
 
-    def note_on(self, octave, note_index, play=True):
-        self.driver.note(octave, note_index, True)
+    def note_on(self, octave, note_index, play=True, origin=None):
         if play:
-            super().note_on(octave, note_index)
+            super().note_on(octave, note_index, origin=origin)
+        self.driver.note(octave, note_index, True, origin)
 
     def note_off(self, octave, note_index, play=True):
         if play:
@@ -743,68 +1219,130 @@ class Piano(sublime_plugin.ViewEventListener, PianoMidi):
         self.driver.note(octave, note_index, False)
 
 
+class PianoTuneHighlighter:
+    """
+    Highlights the instructions of a piano tune that are currently playing.
+    Like PianoDisplayDriver, updates are coalesced so that the view is updated
+    at most piano_update_fps times a second, from the main thread, no matter
+    how many notes start and stop in between.
+    """
+    def __init__(self, view, region_key='piano_seq_current_note'):
+        self.view = view
+        self.region_key = region_key
+        self.scope = piano_prefs('scope_to_highlight_current_piano_tune_note')
+
+        # How many times each span, as (begin, end), is currently playing; a
+        # span can be playing more than once, i.e. a label that is referenced
+        # in a chord.
+        self.active_spans = Counter()
+        self.update = 0
+        self.update_lock = threading.Lock()
+
+        self.delay = 1000 / max(1, min(piano_prefs('piano_update_fps') or 1000, 1000))
+
+    def on(self, span):
+        with self.update_lock:
+            self.active_spans[(span.begin(), span.end())] += 1
+        self.request_render()
+
+    def off(self, span):
+        key = (span.begin(), span.end())
+        with self.update_lock:
+            self.active_spans[key] -= 1
+            if self.active_spans[key] <= 0:
+                del self.active_spans[key]
+        self.request_render()
+
+    def clear(self):
+        with self.update_lock:
+            self.active_spans.clear()
+        self.request_render()
+
+    def request_render(self):
+        if not self.update:
+            self.update = 1
+            sublime.set_timeout(self.render, self.delay)
+
+    def render(self):
+        with self.update_lock:
+            regions = [sublime.Region(*span) for span in self.active_spans]
+            self.update = 0
+
+        if regions:
+            self.view.add_regions(self.region_key, regions, self.scope)
+        else:
+            self.view.erase_regions(self.region_key)
+
+
+class PianoTuneChangeListener(sublime_plugin.TextChangeListener):
+    """
+    Invalidates the resolver checkpoints of a piano tune from the first point
+    that was edited; on_modified on the view doesn't say where the edit was.
+    """
+    def __init__(self, checkpoints):
+        super().__init__()
+        self.checkpoints = checkpoints
+
+    def on_text_changed(self, changes):
+        self.checkpoints.invalidate(min(change.a.pt for change in changes))
+
+
 class PianoTune(sublime_plugin.ViewEventListener, PianoMidi):
     @classmethod
     def is_applicable(cls, settings):
         syntax = settings.get('syntax')
         return syntax.endswith('/PianoTune.sublime-syntax')
 
+    def __init__(self, view):
+        super().__init__(view)
+        # Resolved states at regular intervals through the tune, so that
+        # finding the state at a point doesn't need to start from the top.
+        self.checkpoints = piano_tunes.TuneCheckpoints()
+        self.change_listener = PianoTuneChangeListener(self.checkpoints)
+        self.change_listener.attach(view.buffer())
+
+    def resolve_up_to(self, point):
+        """
+        Resolve the tune from the nearest checkpoint up to point, returning the
+        resolved states and the resolver, which holds the state at point.
+        """
+        def instructions_from(offset):
+            return piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, [sublime.Region(offset, point)]))
+        def tune_instructions():
+            return piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, [sublime.Region(0, self.view.size())]))
+        return self.checkpoints.resolve(instructions_from, point, tune_instructions)
+
     def find_piano(self):
-        piano = get_piano_view()
-        if piano:
-            return sublime_plugin.find_view_event_listener(piano, Piano)
+        return find_piano_listener()
 
-    def note_on(self, octave, note_index):
+    def note_on(self, octave, note_index, origin=None, channel=0):
         listener = self.find_piano()
         if listener:
-            listener.note_on(octave, note_index, False)
-        super().note_on(octave, note_index)
+            listener.note_on(octave, note_index, False, origin)
+        super().note_on(octave, note_index, origin=origin, channel=channel)
 
-    def note_off(self, octave, note_index):
-        super().note_off(octave, note_index)
+    def note_off(self, octave, note_index, channel=0):
+        super().note_off(octave, note_index, channel=channel)
         listener = self.find_piano()
         if listener:
             listener.note_off(octave, note_index, False)
 
-    playback_stopped = True
-
-    def play_midi_instructions(self, messages: Iterable[piano_tunes.PianoTuneMidiHighlight]):
-        self.playback_stopped = False
-        def play():
-            current_instruction_regions = list()
-            time_elapsed = 0
-            for item in messages:
-                if self.playback_stopped and item.on:
-                    # if playback has stopped, process all note_off messages
-                    # - ignoring the timings. This saves us from having to reset
-                    #   the output port. i.e. skip all note_on messages
-                    continue
-
-                time_delta = item.time_elapsed - time_elapsed
-                msg = item.to_midi_message(time_delta)
-
-                if time_delta > 0 and not self.playback_stopped:
-                    time.sleep(time_delta / 1000)
-                time_elapsed = item.time_elapsed
-                if msg:
-                    octave = item.state.current_octave
-                    note_index = item.state.instruction.value
-                    getattr(self, msg.type)(octave, note_index)
-
-                span = item.state.instruction.span
-                if item.on:
-                    current_instruction_regions.append(span)
-                else:
-                    current_instruction_regions.remove(span)
-                self.view.add_regions('piano_seq_current_note', current_instruction_regions, piano_prefs('scope_to_highlight_current_piano_tune_note'))
-                # when there are no notes being played, and playback has stopped, exit the loop
-                if not current_instruction_regions and self.playback_stopped:
-                    break
+    # The PianoTunePlayback of the tune while it's playing
+    playback = None
 
-            self.view.erase_regions('piano_seq_current_note')
-            self.playback_stopped = True
+    def playback_stream(self, tune: piano_tunes.CompiledTune, channel=0):
+        self.playback = PianoTunePlayback(self, tune, channel)
+        return self.playback
 
-        threading.Thread(target=play).start()
+    def play_tune(self, tune: piano_tunes.CompiledTune, channel=0, offset=None):
+        """play a compiled tune, from the instruction at offset if given"""
+        if self.playback:
+            self.playback.stop()
+        stream = self.playback_stream(tune, channel)
+        if offset is not None:
+            stream.seek_to_offset(offset)
+        playback_scheduler.spin = piano_prefs('piano_tune_playback_spin_wait')
+        playback_scheduler.add(stream)
 
     def on_hover(self, point, hover_zone):
         if hover_zone == sublime.HOVER_TEXT:
@@ -812,6 +1350,254 @@ class PianoTune(sublime_plugin.ViewEventListener, PianoMidi):
                 self.view.run_command('show_piano_note_details', { 'point': point })
 
 
+class PianoTunePlayback(piano_playback.PlaybackStream):
+    """
+    Plays a compiled piano-tune as a stream of the playback scheduler, sounding
+    the notes on the stream's channel, lighting them up on the piano and
+    highlighting the instructions that are playing.
+
+    Like MidiFilePlayer, the position in the tune is worked out from
+    perf_counter, relative to the tune time and clock time it was last rebased
+    at, and the other methods can be called from any thread to pause, seek,
+    loop a region, change the speed or transpose the tune while it plays. The
+    tune's events are indexed by time (see TuneTimeIndex), so seeking is a
+    bisect, and the speed and transposition are applied as the events are
+    played, so the tune never needs to be compiled again.
+    """
+    def __init__(self, listener, tune: piano_tunes.CompiledTune, channel=0, speed=1.0, transpose=0):
+        super().__init__(playback_scheduler, channel)
+        self.listener = listener
+        self.tune = tune
+        self.time_index = piano_tunes.TuneTimeIndex(tune)
+        # the position in the tune's event_order of the next event to play
+        self.next_event = 0
+        self.highlighter = PianoTuneHighlighter(listener.view)
+        # the instructions that are playing, by tune index, with the midi note
+        # each one sounded (None if it doesn't sound one), so they can be
+        # turned off when playback is paused, seeked or stopped
+        self.playing = dict()
+        self.speed = speed
+        self.transpose = transpose
+        self.paused = False
+        # the (start, end) tune times of the region being looped, if any
+        self.loop = None
+        # the tune time, in ms, at the clock time it was rebased at
+        self.base_time = 0
+        self.base_clock = time.perf_counter()
+
+    def position(self, now=None):
+        """the current time in the tune, in ms"""
+        if self.paused:
+            return self.base_time
+        if now is None:
+            now = time.perf_counter()
+        return self.base_time + (now - self.base_clock) * 1000 * self.speed
+
+    def rebase(self, time_elapsed, now=None):
+        self.base_time = time_elapsed
+        self.base_clock = time.perf_counter() if now is None else now
+
+    def clock_at(self, time_elapsed):
+        """the perf_counter time that the tune reaches time_elapsed"""
+        return self.base_clock + (time_elapsed - self.base_time) / 1000 / self.speed
+
+    def next_time(self):
+        """the tune time of the next event, or of the end of the loop"""
+        time_elapsed = None
+        if self.next_event < len(self.time_index):
+            time_elapsed = self.time_index.event_time[self.next_event]
+        if self.loop and (time_elapsed is None or time_elapsed >= self.loop[1]):
+            return self.loop[1]
+        return time_elapsed
+
+    def start(self, now):
+        self.rebase(self.base_time, now)
+
+    def deadline(self):
+        time_elapsed = self.next_time()
+        if self.paused or time_elapsed is None:
+            return None
+        return self.clock_at(time_elapsed)
+
+    def done(self):
+        return self.stopped or (self.loop is None and self.next_event >= len(self.time_index))
+
+    def transposed_note(self, index):
+        """the midi note an instruction sounds, transposed, or None"""
+        if self.tune.kind[index] != piano_tunes.KIND_NOTE:
+            return None
+        midi_note = self.tune.note[index] + self.transpose
+        return midi_note if 0 <= midi_note <= piano_layouts.MAX_NOTE else None
+
+    def span(self, index):
+        return sublime.Region(self.tune.span_begin[index], self.tune.span_end[index])
+
+    def send_notes(self, on, audible=True):
+        """turn the notes of the playing instructions on or off"""
+        piano = self.listener.find_piano()
+        burst = list()
+        for midi_note in self.playing.values():
+            if midi_note is None:
+                continue
+            if audible or not on:
+                burst.append(piano_midi_output.note_message(midi_note, on, self.channel))
+            if piano:
+                if on:
+                    piano.note_on(*PianoMidi.midi_note_to_note(midi_note), False)
+                else:
+                    piano.note_off(*PianoMidi.midi_note_to_note(midi_note), False)
+        if burst and raw_out:
+            raw_out.send_burst(burst)
+
+    def jump(self, time_elapsed, audible=True):
+        """
+        Carry on from time_elapsed, with the notes and highlights of the
+        instructions that are playing at that point; call with the lock held.
+        """
+        if not self.paused:
+            self.send_notes(False)
+        self.next_event = self.time_index.position_at(time_elapsed)
+        self.playing = { index: self.transposed_note(index) for index in self.time_index.playing_at(self.next_event) }
+        self.highlighter.clear()
+        for index in self.playing:
+            self.highlighter.on(self.span(index))
+        if not self.paused:
+            # the notes get sounded when playback resumes otherwise
+            self.send_notes(True, audible)
+
+    def play_due(self, now, audible):
+        # The notes that are due are shown on the piano as they're read, but
+        # sent out together afterwards, so that a chord goes out as one burst.
+        piano = self.listener.find_piano()
+        burst = list()
+        event_order = self.tune.event_order
+        # NOTE: the deadlines are worked out from the time the tune was last
+        #       rebased, rather than the time since the last event, so the
+        #       tune doesn't drift
+        while True:
+            time_elapsed = self.next_time()
+            if time_elapsed is None or self.clock_at(time_elapsed) > now:
+                break
+
+            if self.loop and time_elapsed >= self.loop[1]:
+                # back to the start of the loop, on the clock time the end of
+                # the loop was due, so looping doesn't drift either
+                if burst and raw_out:
+                    raw_out.send_burst(burst)
+                burst = list()
+                loop_clock = self.clock_at(self.loop[1])
+                self.jump(self.loop[0], audible)
+                self.rebase(self.loop[0], loop_clock)
+                continue
+
+            event = event_order[self.next_event]
+            index = event >> 1
+            if event & 1:
+                midi_note = self.transposed_note(index)
+                self.playing[index] = midi_note
+                if midi_note is not None:
+                    if audible:
+                        burst.append(piano_midi_output.note_message(midi_note, True, self.channel))
+                    if piano:
+                        piano.note_on(*PianoMidi.midi_note_to_note(midi_note), False)
+                self.highlighter.on(self.span(index))
+            elif index in self.playing:
+                midi_note = self.playing.pop(index)
+                if midi_note is not None:
+                    burst.append(piano_midi_output.note_message(midi_note, False, self.channel))
+                    if piano:
+                        piano.note_off(*PianoMidi.midi_note_to_note(midi_note), False)
+                self.highlighter.off(self.span(index))
+            self.next_event += 1
+
+        if burst and raw_out:
+            raw_out.send_burst(burst)
+
+    def pause(self):
+        with self.condition:
+            if self.paused or self.stopped:
+                return
+            self.base_time = self.position()
+            self.paused = True
+            self.send_notes(False)
+            self.condition.notify_all()
+
+    def resume(self):
+        with self.condition:
+            if not self.paused:
+                return
+            self.send_notes(True, self.scheduler.audible(self))
+            self.rebase(self.base_time)
+            self.paused = False
+            self.condition.notify_all()
+
+    def toggle_pause(self):
+        if self.paused:
+            self.resume()
+        else:
+            self.pause()
+
+    def seek(self, time_elapsed):
+        """continue playback from time_elapsed ms into the tune"""
+        with self.condition:
+            time_elapsed = max(0, min(time_elapsed, self.time_index.duration))
+            self.jump(time_elapsed, self.scheduler.audible(self))
+            self.rebase(time_elapsed)
+            self.condition.notify_all()
+
+    def seek_to_offset(self, offset):
+        """continue playback from the first instruction at or after offset"""
+        self.seek(self.time_index.time_at_offset(offset))
+
+    def set_loop(self, start=None, end=None):
+        """
+        Loop the tune between the start and end times, in ms; without a start
+        and end, or if they're the wrong way round, stop looping and play on to
+        the end of the tune.
+        """
+        with self.condition:
+            self.loop = None
+            if start is not None and end is not None:
+                start = max(0, start)
+                end = min(end, self.time_index.duration)
+                if end > start:
+                    self.loop = (start, end)
+            self.condition.notify_all()
+
+    def loop_offsets(self, begin, end):
+        """loop the instructions between the begin and end source offsets"""
+        self.set_loop(self.time_index.time_at_offset(begin), self.time_index.time_at_offset(end))
+
+    def set_speed(self, speed):
+        with self.condition:
+            self.rebase(self.position())
+            self.speed = max(0.01, speed)
+            self.condition.notify_all()
+
+    def set_transpose(self, transpose):
+        """transpose the tune by a number of semitones, from the notes that
+        are playing now"""
+        with self.condition:
+            if not self.paused:
+                self.send_notes(False)
+            self.transpose = transpose
+            self.playing = { index: self.transposed_note(index) for index in self.playing }
+            if not self.paused:
+                self.send_notes(True, self.scheduler.audible(self))
+
+    def finish(self):
+        # if playback was stopped part way through, turn off the notes that
+        # are still on, rather than having to reset the output port
+        for midi_note in self.playing.values():
+            if midi_note is not None:
+                self.listener.note_off(*PianoMidi.midi_note_to_note(midi_note), channel=self.channel)
+        self.highlighter.clear()
+        if self.listener.playback is self:
+            self.listener.playback = None
+        print('piano: piano-tune playback timing', self.lateness.report())
+        super().finish()
+
+
 class ShowPianoNoteDetailsCommand(sublime_plugin.TextCommand):
     def run(self, edit, point=None):
         # TODO: take a list of positions instead?
@@ -822,17 +1608,18 @@ class ShowPianoNoteDetailsCommand(sublime_plugin.TextCommand):
         check_tokens = self.view.extract_tokens_with_scopes(sublime.Region(point, point + 4))
         if len(check_tokens) > 1:
             token_to_show = check_tokens[0]
-            if sublime.score_selector(check_tokens[1][1], 'constant.language.sharp') > 0:
+            if piano_tunes.classify_scope(check_tokens[1][1]) == 'sharp':
                 token_to_show = check_tokens[1]
             point = token_to_show[0].end()
 
         # we could get all the tokens, but we don't need anything after the mouse cursor to show the state, so this saves time
-        # and makes it easier to get the parse_state for the token under the mouse cursor - it's the last token we parsed
-        instructions = piano_tunes.parse_piano_tune(piano_tunes.get_tokens_from_regions(self.view, [sublime.Region(0, point)]))
-        # get the last instruction from an iterator
-        # https://stackoverflow.com/a/3169701/4473405
-        # (seems less wasteful than making it a list to get the -1 index)
-        parse_state = deque(piano_tunes.resolve_piano_tune_instructions(instructions), maxlen=1).pop()
+        # and makes it easier to get the parse_state for the token under the mouse cursor - it's the last token we parsed.
+        # Resolving starts from the nearest checkpoint before the cursor rather than from the top of the file
+        listener = sublime_plugin.find_view_event_listener(self.view, PianoTune)
+        states, _ = listener.resolve_up_to(point)
+        if not states:
+            return
+        parse_state = states[-1]
 
         note_index = parse_state.instruction.value
         self.view.show_popup(
@@ -876,7 +1663,7 @@ class MidiEventListener(sublime_plugin.EventListener):
         if key != 'midi_file_playing':
             return None
 
-        lhs = PlayMidiFileCommand.midi is not None
+        lhs = PlayMidiFileCommand.player is not None
         rhs = bool(operand)
 
         if operator == sublime.OP_EQUAL:
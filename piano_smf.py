@@ -0,0 +1,163 @@
+import mmap
+import struct
+from base64 import b64decode
+from heapq import merge
+from operator import itemgetter
+from urllib.parse import unquote_to_bytes
+
+
+# The tempo of a midi file until it sets one, in microseconds per beat
+DEFAULT_TEMPO = 500000
+
+# The number of data bytes that follow each type of channel message status
+CHANNEL_MESSAGE_LENGTHS = {
+    0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2,
+}
+
+# The meta message type of a tempo change, and the end of a track
+META_SET_TEMPO = 0x51
+META_END_OF_TRACK = 0x2F
+
+
+class MidiFileBuffer:
+    """
+    The bytes of a standard midi file, memory mapped from disk (or decoded from
+    a data URI), with the header parsed and the track chunks found; the tracks
+    themselves are only decoded as playback reaches them.
+    """
+    def __init__(self, data, file=None):
+        self.data = data
+        self.file = file
+
+        if data[:4] != b'MThd':
+            raise ValueError('not a midi file')
+        header_length, self.type, track_count, self.division = struct.unpack_from('>IHHH', data, 4)
+
+        # find the start and end of each track chunk, skipping any chunks of
+        # a type that isn't known
+        self.tracks = list()
+        offset = 8 + header_length
+        while offset + 8 <= len(data) and len(self.tracks) < track_count:
+            chunk_type = data[offset:offset + 4]
+            chunk_length, = struct.unpack_from('>I', data, offset + 4)
+            offset += 8
+            if chunk_type == b'MTrk':
+                self.tracks.append((offset, min(offset + chunk_length, len(data))))
+            offset += chunk_length
+
+    @classmethod
+    def open(cls, file_name):
+        """open a midi file by name, or a midi data URI"""
+        if file_name.startswith('data:'):
+            header, _, payload = file_name.partition(',')
+            if header.endswith(';base64'):
+                return cls(b64decode(payload))
+            return cls(unquote_to_bytes(payload))
+
+        file = open(file_name, 'rb')
+        try:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), file)
+        except:
+            file.close()
+            raise
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seconds_per_tick(self, tempo):
+        if self.division & 0x8000:
+            # SMPTE timing; frames per second (as a negative byte) and ticks
+            # per frame, and the tempo doesn't come into it
+            frames_per_second = 256 - (self.division >> 8)
+            return 1 / (frames_per_second * (self.division & 0xFF))
+        return tempo / (1000000 * self.division)
+
+    def iter_track(self, index):
+        """
+        Decode a track as it's iterated, yielding (tick, message bytes) pairs
+        with absolute ticks; set_tempo is yielded as (tick, tempo), since it's
+        the only meta message that playback needs.
+
+        The bytes are those of the message as it's sent, with any running
+        status filled in; building a mido message is left to the player, for
+        the messages it actually sends.
+        """
+        data = self.data
+        offset, end = self.tracks[index]
+        tick = 0
+        status = 0
+        while offset < end:
+            delta, offset = read_variable_length(data, offset)
+            tick += delta
+
+            byte = data[offset]
+            if byte == 0xFF:
+                meta_type = data[offset + 1]
+                length, offset = read_variable_length(data, offset + 2)
+                if meta_type == META_END_OF_TRACK:
+                    return
+                if meta_type == META_SET_TEMPO and length == 3:
+                    yield tick, int.from_bytes(data[offset:offset + 3], 'big')
+                offset += length
+            elif byte == 0xF0 or byte == 0xF7:
+                length, offset = read_variable_length(data, offset + 1)
+                # NOTE: F7 chunks are escape sequences, which aren't sent on
+                if byte == 0xF0:
+                    sysex = data[offset:offset + length]
+                    if sysex.endswith(b'\xF7'):
+                        sysex = sysex[:-1]
+                    yield tick, b'\xF0' + sysex + b'\xF7'
+                offset += length
+            else:
+                # running status; the status of the previous channel message
+                # carries on when a data byte comes next
+                if byte >= 0x80:
+                    status = byte
+                    offset += 1
+                elif not status:
+                    raise ValueError('running status without a status byte')
+                length = CHANNEL_MESSAGE_LENGTHS[status & 0xF0]
+                yield tick, bytes((status,)) + data[offset:offset + length]
+                offset += length
+
+    def __iter__(self):
+        """
+        Yield (seconds, message bytes) pairs for the whole file, with the tracks
+        merged as they're decoded, so the first messages are available as
+        soon as the start of each track has been read.
+        """
+        if self.type == 2:
+            raise TypeError("can't merge the tracks of an asynchronous (type 2) midi file")
+
+        seconds_per_tick = self.seconds_per_tick(DEFAULT_TEMPO)
+        seconds = 0
+        last_tick = 0
+        # NOTE: merge is stable, so messages at the same tick come out in
+        #       track order, the same as mido's merge_tracks
+        for tick, msg in merge(*(self.iter_track(index) for index in range(len(self.tracks))), key=itemgetter(0)):
+            seconds += (tick - last_tick) * seconds_per_tick
+            last_tick = tick
+            if isinstance(msg, int):
+                seconds_per_tick = self.seconds_per_tick(msg)
+            else:
+                yield seconds, msg
+
+
+def read_variable_length(data, offset):
+    """read a variable length quantity, returning it and the offset after it"""
+    value = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, offset
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import struct
+import sys
+try:
+    from . import piano_tunes
+except ImportError:
+    import piano_tunes
+
+
+# Bump this whenever the file format below changes
+CACHE_FORMAT_VERSION = 2
+
+CACHE_MAGIC = b'PTUNE'
+# magic, format version, little endian, number of entries, number of events
+CACHE_HEADER = struct.Struct('<5sH?II')
+
+
+def encode_tune(tune):
+    """encode a CompiledTune to the binary cache format; the header followed by
+    the raw bytes of each column of the tune, in the order of its __slots__"""
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, sys.byteorder == 'little', len(tune), len(tune.event_order))
+    return header + b''.join(column.tobytes() for column in tune.columns())
+
+
+def decode_tune(data):
+    """decode a CompiledTune from the binary cache format, or return None if
+    the data isn't valid"""
+    if len(data) < CACHE_HEADER.size:
+        return None
+    magic, version, little_endian, count, event_count = CACHE_HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC or version != CACHE_FORMAT_VERSION or little_endian != (sys.byteorder == 'little'):
+        return None
+
+    tune = piano_tunes.CompiledTune()
+    offset = CACHE_HEADER.size
+    for column in tune.columns():
+        size = (event_count if column is tune.event_order else count) * column.itemsize
+        if offset + size > len(data):
+            return None
+        column.frombytes(data[offset:offset + size])
+        offset += size
+    return tune if offset == len(data) else None
+
+
+class CompiledTuneCache:
+    """
+    An on disk cache of compiled piano tunes, keyed by a hash of the text of
+    the tune and the compiler version, so a tune that hasn't changed doesn't
+    need to be tokenized, parsed and resolved again.
+
+    The least recently used tunes are removed when the cache grows larger than
+    max_size bytes; reading a tune from the cache touches its file.
+    """
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, text):
+        digest = hashlib.sha256()
+        digest.update(('%d:%d:' % (piano_tunes.COMPILER_VERSION, CACHE_FORMAT_VERSION)).encode())
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.directory, key + '.ptune')
+
+    def get(self, text):
+        """the CompiledTune for the tune text, or None if it isn't cached"""
+        file_name = self.file_name(self.key(text))
+        try:
+            with open(file_name, 'rb') as file:
+                tune = decode_tune(file.read())
+            os.utime(file_name)
+        except OSError:
+            return None
+        return tune
+
+    def put(self, text, tune):
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = self.file_name(self.key(text))
+        # NOTE: write to a temporary file first, so that a reader never sees a
+        #       partly written file
+        temp_file_name = file_name + '.%d.tmp' % os.getpid()
+        with open(temp_file_name, 'wb') as file:
+            file.write(encode_tune(tune))
+        os.replace(temp_file_name, file_name)
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used tunes until the cache fits in max_size"""
+        entries = list()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.ptune'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(file_name)
+            except OSError:
+                continue
+            total_size -= size
+
+    def compile(self, text, compile_tune):
+        """return the CompiledTune for the tune text from the cache, or call
+        compile_tune to compile it and store the result in the cache"""
+        tune = self.get(text)
+        if tune is None:
+            tune = compile_tune()
+            try:
+                self.put(text, tune)
+            except OSError as e:
+                print('piano: unable to cache compiled piano-tune:', e)
+        return tune
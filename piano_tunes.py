@@ -1,20 +1,56 @@
-import sublime
 from dataclasses import dataclass
 from typing import Iterable, NamedTuple, Union
 import mido
+import re
 from abc import ABC
 from operator import itemgetter, attrgetter
 from itertools import chain
+from bisect import bisect_left
+from heapq import heappush, heappop
+from array import array
+try:
+    import sublime
+except ImportError:
+    # NOTE: this allows piano tunes to be compiled outside of Sublime Text,
+    # i.e. in batch jobs; tokenize_piano_tune is used in place of the view
+    sublime = None
+
+
+if sublime:
+    Region = sublime.Region
+else:
+    class Region(NamedTuple):
+        """a stand in for sublime.Region, holding plain text offsets"""
+        a: int
+        b: int
+
+        def begin(self):
+            return min(self.a, self.b)
+
+        def end(self):
+            return max(self.a, self.b)
+
+        def size(self):
+            return abs(self.b - self.a)
+
+        def empty(self):
+            return self.a == self.b
+
+        def cover(self, other):
+            return Region(min(self.begin(), other.begin()), max(self.end(), other.end()))
+
+        def contains(self, point):
+            return self.begin() <= point <= self.end()
 
 
 class Token(NamedTuple):
-    region: sublime.Region
+    region: Region
     scope: str
     text: str
 
 @dataclass
 class TuneInstruction(ABC):
-    span: sublime.Region
+    span: Region
     value: Union[int, str]
 
 @dataclass
@@ -79,6 +115,17 @@ class PianoTuneMidiHighlight:
         note_index = self.state.instruction.value
         return mido.Message('note_' + ('on' if self.on else 'off'), note=note_to_midi_note(octave, note_index), time=int(time_delta))
 
+    @property
+    def midi_note(self):
+        """the midi note to play, or None if this isn't a note"""
+        if not isinstance(self.state.instruction, NoteInstruction):
+            return None
+        return note_to_midi_note(self.state.current_octave, self.state.instruction.value)
+
+    @property
+    def span(self):
+        return self.state.instruction.span
+
 
 def note_to_midi_note(octave, note_index):
     return octave * 12 + note_index
@@ -96,6 +143,164 @@ def get_tokens_from_regions(view, regions):
         for token in tokens:
             yield Token(region=token[0], scope=token[1], text=region_text[token[0].begin() - region.begin():token[0].end() - region.begin()])
 
+def score_selector(scope: str, selector: str):
+    """sublime.score_selector, or when running outside of Sublime Text, a basic
+    version of it which supports selectors made of a single scope"""
+    if sublime:
+        return sublime.score_selector(scope, selector)
+    selector_atoms = selector.strip().split('.')
+    for scope_name in scope.split():
+        if scope_name.split('.')[:len(selector_atoms)] == selector_atoms:
+            return len(selector_atoms)
+    return 0
+
+# The rules from PianoTune.sublime-syntax, used by tokenize_piano_tune; each
+# rule is (regex, scope of the match, scopes of the capture groups, action),
+# where the action is None, 'pop', or the name of a context to push.
+# NOTE: this must be kept in sync with the syntax definition
+PIANO_TUNE_SYNTAX_RULES = {
+    'comments': [
+        (r'//', 'punctuation.definition.comment.piano-tune', {}, 'comment-line'),
+        (r'/\*', 'punctuation.definition.comment.begin.piano-tune', {}, 'comment-block'),
+    ],
+    'instructions': [
+        (r'([-\w]+)(:)', None, {1: 'entity.name.label.piano-tune', 2: 'punctuation.section.block.begin.piano-tune'}, None),
+        (r'-+', 'punctuation.section.block.end.piano-tune', {}, None),
+        (r'(&)([-\w]+)', None, {1: 'keyword.control.flow.piano-tune', 2: 'support.function.piano-tune'}, None),
+        (r'(?i)(l)(\d{1,2})', None, {1: 'keyword.operator.length.piano-tune', 2: 'constant.numeric.integer.decimal.piano-tune'}, None),
+        (r'(?i)(p)(\d{1,2})', None, {1: 'keyword.operator.pause.piano-tune', 2: 'constant.numeric.integer.decimal.piano-tune'}, None),
+        (r'(?i)(o)(\d{1,2})', None, {1: 'keyword.operator.octave.piano-tune', 2: 'constant.numeric.integer.decimal.piano-tune'}, None),
+        (r'[<>]', 'keyword.operator.bitwise.octave.piano-tune', {}, None),
+        (r'(?i)(t)(\d{1,3})', None, {1: 'keyword.operator.tempo.piano-tune', 2: 'constant.numeric.integer.decimal.piano-tune'}, None),
+        (r'/', 'keyword.operator.simultaneous.begin.piano-tune', {}, 'simultaneous'),
+    ],
+    'notes': [
+        (r'(?i)\b(DO|RE|MI|FA|SOL|LA|SI)\b(#)?', None, {1: 'constant.language.note.solfege.piano-tune', 2: 'constant.language.sharp.piano-tune'}, None),
+        (r'(?i)\b([abcdefg])\b(#)?', None, {1: 'constant.language.note.letter.piano-tune', 2: 'constant.language.sharp.piano-tune'}, None),
+    ],
+    'simultaneous-end': [
+        (r'/', 'keyword.operator.simultaneous.end.piano-tune', {}, 'pop'),
+    ],
+    'comment-line-end': [
+        (r'$\n?', None, {}, 'pop'),
+    ],
+    'comment-block-end': [
+        (r'\*/', 'punctuation.definition.comment.end.piano-tune', {}, 'pop'),
+    ],
+}
+
+# context name: (meta scope, rules to include, in order)
+PIANO_TUNE_SYNTAX_CONTEXTS = {
+    'main': (None, ('comments', 'instructions', 'notes')),
+    'simultaneous': ('meta.group.simultaneous.piano-tune', ('comments', 'simultaneous-end', 'instructions', 'notes')),
+    # NOTE: the prototype is not applied to the contexts pushed by the prototype
+    'comment-line': ('comment.line.piano-tune', ('comment-line-end',)),
+    'comment-block': ('comment.block.piano-tune', ('comment-block-end',)),
+}
+
+def compile_syntax_contexts():
+    contexts = dict()
+    for name, (meta_scope, includes) in PIANO_TUNE_SYNTAX_CONTEXTS.items():
+        rules = list()
+        for include in includes:
+            for pattern, scope, captures, action in PIANO_TUNE_SYNTAX_RULES[include]:
+                rules.append((re.compile(pattern, re.MULTILINE), scope, captures, action))
+        contexts[name] = (meta_scope, rules)
+    return contexts
+
+syntax_contexts = compile_syntax_contexts()
+
+def tokenize_piano_tune(text: str, offset: int = 0):
+    """a pure Python equivalent of running View.extract_tokens_with_scopes over
+    a piano tune using PianoTune.sublime-syntax, yielding the same Tokens as
+    get_tokens_from_regions does, so tunes can be compiled without a view.
+    offset is added to all the token regions."""
+    stack = ['main']
+    line_start = 0
+    for line in text.splitlines(keepends=True):
+        tokens = list()
+        def add(begin, end, scopes):
+            if begin >= end:
+                return
+            scope = ' '.join(scopes) + ' '
+            if tokens and tokens[-1][2] == scope and tokens[-1][1] == begin:
+                tokens[-1][1] = end
+            else:
+                tokens.append([begin, end, scope])
+
+        pos = 0
+        while pos < len(line):
+            meta_scopes = ['text.piano-tune'] + [meta_scope for meta_scope in (syntax_contexts[name][0] for name in stack) if meta_scope]
+            # like Sublime, take whichever rule matches earliest in the line,
+            # with the order of the rules used to break ties
+            best = None
+            for rule in syntax_contexts[stack[-1]][1]:
+                match = rule[0].search(line, pos)
+                if match and (best is None or match.start() < best[0].start()):
+                    best = (match, rule)
+            if best is None:
+                add(pos, len(line), meta_scopes)
+                break
+
+            match, (_, scope, captures, action) = best
+            add(pos, match.start(), meta_scopes)
+            if action not in (None, 'pop'):
+                stack.append(action)
+                meta_scopes = meta_scopes + [syntax_contexts[action][0]]
+            match_scopes = meta_scopes + [scope] if scope else meta_scopes
+            captured_until = match.start()
+            for group, capture_scope in captures.items():
+                if match.start(group) == -1:
+                    continue
+                add(captured_until, match.start(group), match_scopes)
+                add(match.start(group), match.end(group), match_scopes + [capture_scope])
+                captured_until = match.end(group)
+            add(captured_until, match.end(), match_scopes)
+            if action == 'pop':
+                stack.pop()
+
+            if match.end() == pos and action is None:
+                # guard against looping forever on an empty match
+                add(pos, pos + 1, meta_scopes)
+                pos += 1
+            else:
+                pos = match.end()
+
+        for begin, end, scope in tokens:
+            yield Token(region=Region(offset + line_start + begin, offset + line_start + end), scope=scope, text=line[begin:end])
+        line_start += len(line)
+
+# The kinds of token parse_piano_tune is interested in, with the selector
+# that identifies each of them; the first matching selector wins.
+TOKEN_KIND_SELECTORS = (
+    ('relative_octave', 'keyword.operator.bitwise.octave'),
+    ('absolute_octave', 'keyword.operator.octave'),
+    ('tempo', 'keyword.operator.tempo'),
+    ('length', 'keyword.operator.length'),
+    ('pause', 'keyword.operator.pause'),
+    ('note', 'constant.language.note'),
+    ('sharp', 'constant.language.sharp'),
+    ('simultaneous', 'keyword.operator.simultaneous'),
+    ('label', 'entity.name.label'),
+    ('label_end', 'punctuation.section.block.end'),
+    ('label_reference', 'keyword.control.flow'),
+)
+
+# NOTE: a tune only ever contains a handful of distinct scopes, so rather than
+# scoring every token against every selector, the kind is cached per scope
+scope_kinds = dict()
+
+def classify_scope(scope: str):
+    """return the kind of token (from TOKEN_KIND_SELECTORS) the given scope
+    represents, or None if it isn't a token we are interested in"""
+    try:
+        return scope_kinds[scope]
+    except KeyError:
+        pass
+    kind = next((kind for kind, selector in TOKEN_KIND_SELECTORS if score_selector(scope, selector)), None)
+    scope_kinds[scope] = kind
+    return kind
+
 def parse_piano_tune(tokens: Iterable[Token]):
     """convert raw tokens from the syntax definition to piano tune instruction tokens"""
     notes_solfege = 'do do# re re# mi fa fa# sol sol# la la# si'.split() # TODO: reuse this from PianoMidi
@@ -112,141 +317,604 @@ def parse_piano_tune(tokens: Iterable[Token]):
             break
 
         start_region = current_token.region
+        kind = classify_scope(current_token.scope)
 
-        if sublime.score_selector(current_token.scope, 'keyword.operator.bitwise.octave'):
+        if kind == 'relative_octave':
             if current_token.text == '<':
                 yield RelativeOctaveInstruction(current_token.region, -1)
             elif current_token.text == '>':
                 yield RelativeOctaveInstruction(current_token.region, 1)
-        elif sublime.score_selector(current_token.scope, 'keyword.operator.octave'):
+        elif kind == 'absolute_octave':
             current_token = next(it)
             yield AbsoluteOctaveInstruction(current_token.region.cover(start_region), int(current_token.text))
-        elif sublime.score_selector(current_token.scope, 'keyword.operator.tempo'):
+        elif kind == 'tempo':
             current_token = next(it)
             yield TempoInstruction(current_token.region.cover(start_region), int(current_token.text))
-        elif sublime.score_selector(current_token.scope, 'keyword.operator.length'):
+        elif kind == 'length':
             current_token = next(it)
             yield LengthInstruction(current_token.region.cover(start_region), int(current_token.text))
-        elif sublime.score_selector(current_token.scope, 'keyword.operator.pause'):
+        elif kind == 'pause':
             current_token = next(it)
             yield PauseInstruction(current_token.region.cover(start_region), int(current_token.text))
-        elif sublime.score_selector(current_token.scope, 'constant.language.note'):
+        elif kind == 'note':
             find_note_in = notes_letters if current_token.region.size() == 1 else notes_solfege
             note_index = find_note_in.index(current_token.text.lower())
             
             prev_token = current_token
             current_token = next(it, None)
-            if current_token and sublime.score_selector(current_token.scope, 'constant.language.sharp'):
+            if current_token and classify_scope(current_token.scope) == 'sharp':
                 note_index += 1
                 yield NoteInstruction(current_token.region.cover(start_region), note_index)
             else:
                 take_next = False
                 yield NoteInstruction(prev_token.region, note_index)
-        elif sublime.score_selector(current_token.scope, 'keyword.operator.simultaneous'):
+        elif kind == 'simultaneous':
             yield MultipleNotesDelimiterInstruction(current_token.region, 0)
-        elif sublime.score_selector(current_token.scope, 'entity.name.label'):
+        elif kind == 'label':
             label_text = current_token.text
             current_token = next(it)
             yield LabelStartInstruction(current_token.region.cover(start_region), label_text)
-        elif sublime.score_selector(current_token.scope, 'punctuation.section.block.end'):
+        elif kind == 'label_end':
             yield LabelEndInstruction(current_token.region, None) # TODO: store a stack of labels to refer to which label it ends here?
-        elif sublime.score_selector(current_token.scope, 'keyword.control.flow'):
+        elif kind == 'label_reference':
             current_token = next(it)
             yield LabelReferenceInstruction(current_token.region.cover(start_region), current_token.text)
 
 def calculate_duration(tempo: int, note_length: int):
         return (60 / tempo) / note_length * 4 * 1000
 
-def resolve_piano_tune_instructions(instructions: Iterable[NoteInstruction], default_state=TuneState(120, 4, 8, 0, False, None, 0)):
+# Bump this whenever the output of the compile pipeline changes, so that tunes
+# compiled by an older version aren't used from the compiled tune cache
+COMPILER_VERSION = 4
+
+DEFAULT_TUNE_STATE = TuneState(120, 4, 8, 0, False, None, 0)
+
+# how many instructions TuneResolver.resolve processes between checkpoints
+CHECKPOINT_INTERVAL = 128
+
+class ResolverCheckpoint(NamedTuple):
+    """everything needed to carry on resolving a tune from just after the
+    instruction ending at offset, without resolving what came before it"""
+    offset: int
+    state: TuneState
+    max_time_elapsed: float
+    labels: dict
+    instructions_resolved: int = 0
+
+class LabelDefinition(NamedTuple):
+    index: int # the position of the label start in the tune's instructions
+    start: LabelStartInstruction
+    body: list # the instructions between the label start and its end
+
+class TuneResolver:
     """from the piano tune instructions, determine the state at each instruction,
-    specifically how much time has passed since the beginning of the tune"""
-    state = default_state
-    time_elapsed = 0
-    max_time_elapsed = 0
-    labels = dict()
-    states = list()
-    active_label_definition = None
-
-    token = next(instructions, None)
-    while token is not None:
-        time_elapsed = state.time_elapsed
-        if not state.simultaneous_notes or not isinstance(state.instruction, NoteInstruction):
-            time_elapsed += state.duration
-            max_time_elapsed = max(time_elapsed, max_time_elapsed)
-        else:
-            max_time_elapsed = max(time_elapsed + state.duration, max_time_elapsed)
-        state = state._replace(instruction=token, time_elapsed=time_elapsed, duration=0)
-
-        if isinstance(token, LabelStartInstruction):
-            if active_label_definition:
-                labels[active_label_definition]['instructions'].append(token)
-            active_label_definition = token.value
-            labels[active_label_definition] = { 'begin': token.span, 'end': None, 'instructions': list() }
-        elif isinstance(token, LabelEndInstruction):
-            labels[active_label_definition]['end'] = token.span
-            label_instructions = labels[active_label_definition]['instructions']
-            active_label_definition = next((key for key in reversed(labels.keys()) if labels[key]['end'] is None), None)
-            # correctly handle nested instructions
-            if active_label_definition:
-                labels[active_label_definition]['instructions'] += label_instructions
-                labels[active_label_definition]['instructions'].append(token)
-        elif isinstance(token, LabelReferenceInstruction):
-            if active_label_definition:
-                # prevent recursive label instructions
-                if active_label_definition == token.value:
-                    # TODO: log a warning?
+    specifically how much time has passed since the beginning of the tune.
+    The resolver keeps its context between calls to resolve, and can be created
+    from a checkpoint to pick up where an earlier resolve left off.
+
+    Label definitions are found in a first pass over the instructions, so labels
+    can be referenced before they are defined. Each label body is compiled once,
+    with times relative to the start of the label, into a block of states which
+    every reference to it then just offsets by time (and octave, if the label
+    doesn't set an absolute octave)"""
+    def __init__(self, default_state=DEFAULT_TUNE_STATE, checkpoint: ResolverCheckpoint = None, labels: dict = None):
+        self.state = default_state
+        self.max_time_elapsed = 0
+        # label name: tuple of LabelDefinitions, ordered by index
+        self.labels = dict()
+        # the (name, index) of the labels being defined at the current instruction
+        self.open_labels = list()
+        self.instructions_resolved = 0
+        # (label index, entry state): tuple of states relative to the label start
+        self.compiled_labels = dict()
+        # how many references have been skipped because they refer to a label
+        # that is being compiled; a block compiled while any are skipped
+        # depends on which labels were being compiled, so it isn't cached
+        self.recursive_references_skipped = 0
+        # indexes of labels which set an absolute octave somewhere, so they
+        # can't be compiled relative to the octave they are referenced from
+        self.absolute_octave_labels = set()
+        if checkpoint:
+            self.state = checkpoint.state
+            self.max_time_elapsed = checkpoint.max_time_elapsed
+            self.labels = dict(checkpoint.labels)
+            self.instructions_resolved = checkpoint.instructions_resolved
+        if labels is not None:
+            # the label definitions of the whole tune, so that references to
+            # labels defined after the instructions being resolved are found
+            self.labels = dict(labels)
+
+    def checkpoint(self, offset: int):
+        """return a checkpoint of the current context, or None if the resolver
+        is part way through a label definition"""
+        if self.open_labels:
+            return None
+        # NOTE: labels are only copied shallowly, which is fine as the
+        # definitions for each name are stored in a tuple
+        return ResolverCheckpoint(offset, self.state, self.max_time_elapsed, dict(self.labels), self.instructions_resolved)
+
+    def link(self, instructions: list, first_index: int):
+        """first pass: find all the label definitions in the instructions"""
+        open_labels = list()
+        definitions = list()
+        for index, token in enumerate(instructions):
+            if isinstance(token, LabelStartInstruction):
+                open_labels.append(index)
+            elif isinstance(token, LabelEndInstruction) and open_labels:
+                start_index = open_labels.pop()
+                definitions.append((start_index, instructions[start_index + 1:index]))
+        # labels which aren't ended run until the end of the instructions
+        definitions += ((start_index, instructions[start_index + 1:]) for start_index in open_labels)
+
+        for start_index, body in definitions:
+            start = instructions[start_index]
+            existing = self.labels.get(start.value, ())
+            # the definitions may already be known, i.e. from linking the
+            # whole tune before resolving part of it
+            if any(definition.start.span == start.span for definition in existing):
+                continue
+            definition = LabelDefinition(first_index + start_index, start, body)
+            self.labels[start.value] = tuple(sorted(existing + (definition,), key=attrgetter('index')))
+
+    def find_label(self, name: str, index: int):
+        """the definition of the label a reference at index refers to; the last
+        definition before the reference, or failing that, the first after it"""
+        definitions = self.labels.get(name)
+        if not definitions:
+            return None
+        return next((definition for definition in reversed(definitions) if definition.index < index), definitions[0])
+
+    def compile_label(self, definition: LabelDefinition, entry_state: TuneState, compiling: frozenset):
+        """return the states of the label body when entered with entry_state,
+        with times relative to the start of the label, and whether the octaves
+        are relative to the entry state's octave too"""
+        relative_octave = definition.index not in self.absolute_octave_labels
+        key = (definition.index, entry_state.tempo, entry_state.current_length, entry_state.simultaneous_notes, None if relative_octave else entry_state.current_octave)
+        block = self.compiled_labels.get(key)
+        if block is None:
+            start_state = entry_state._replace(current_octave=0 if relative_octave else entry_state.current_octave, time_elapsed=0, duration=0)
+            block = list()
+            recursive_references_skipped = self.recursive_references_skipped
+            self.resolve_instructions(definition.body, definition.index + 1, start_state, 0, block, list(), compiling | { definition.index })
+            if relative_octave and any(isinstance(state.instruction, AbsoluteOctaveInstruction) for state in block):
+                self.absolute_octave_labels.add(definition.index)
+                return self.compile_label(definition, entry_state, compiling)
+            block = tuple(block)
+            if self.recursive_references_skipped == recursive_references_skipped:
+                self.compiled_labels[key] = block
+        return block, relative_octave
+
+    @staticmethod
+    def place_label_block(block: tuple, time_elapsed: float, octave_offset: int):
+        """the states of a compiled label block, placed at time_elapsed and
+        octave_offset. Every time in a block is the start of the label or the
+        end of an earlier state in it, so the times are accumulated from the
+        placed states the same way as resolving the label in place would,
+        rather than adding time_elapsed to each of them; the rounding of that
+        addition could put a note a hair before the end of the note before it,
+        so a repeated note would be turned off as soon as it starts"""
+        # relative time: placed time, for the start and the end of each state
+        placed_times = { 0: time_elapsed }
+        resolved = list()
+        for label_state in block:
+            placed_time = placed_times.get(label_state.time_elapsed)
+            if placed_time is None:
+                placed_time = label_state.time_elapsed + time_elapsed
+            resolved.append(label_state._replace(time_elapsed=placed_time, current_octave=label_state.current_octave + octave_offset))
+            placed_times[label_state.time_elapsed + label_state.duration] = placed_time + label_state.duration
+        return resolved
+
+    def resolve(self, instructions: Iterable[TuneInstruction], on_checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL, states=None):
+        """resolve the instructions and return their states. If on_checkpoint is
+        given, it is called with a checkpoint every checkpoint_interval instructions.
+        states is where the states are added to, a new list if not given; it
+        only needs to support append and +="""
+        instructions = list(instructions)
+        first_index = self.instructions_resolved
+        self.link(instructions, first_index)
+
+        if states is None:
+            states = list()
+        self.state, self.max_time_elapsed = self.resolve_instructions(
+            instructions, first_index, self.state, self.max_time_elapsed, states, self.open_labels, frozenset(),
+            on_checkpoint, checkpoint_interval
+        )
+        self.instructions_resolved = first_index + len(instructions)
+        return states
+
+    def resolve_instructions(self, instructions, first_index, state, max_time_elapsed, states, open_labels, compiling, on_checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """second pass: append the state at each instruction to states, and
+        return the state and max time elapsed after the last one"""
+        until_checkpoint = checkpoint_interval
+
+        for index, token in enumerate(instructions, first_index):
+            time_elapsed = state.time_elapsed
+            if not state.simultaneous_notes or not isinstance(state.instruction, NoteInstruction):
+                time_elapsed += state.duration
+                max_time_elapsed = max(time_elapsed, max_time_elapsed)
+            else:
+                max_time_elapsed = max(time_elapsed + state.duration, max_time_elapsed)
+            state = state._replace(instruction=token, time_elapsed=time_elapsed, duration=0)
+
+            if isinstance(token, LabelStartInstruction):
+                open_labels.append((token.value, index))
+            elif isinstance(token, LabelEndInstruction):
+                if open_labels:
+                    open_labels.pop()
+            elif isinstance(token, LabelReferenceInstruction):
+                definition = self.find_label(token.value, index)
+                # skip references to labels that don't exist, and recursive references
+                # TODO: log a warning?
+                if definition is None:
                     continue
-                labels[active_label_definition]['instructions'].append(token)
-            # TODO: support label references to labels that haven't yet been parsed?
-            label = labels[token.value]
-            resolved = resolve_piano_tune_instructions(iter(label['instructions']), state)
-            # ensure the state duration covers all label instructions, so the reference can be highlighted...
-            if resolved:
-                state = state._replace(duration=resolved[-1].time_elapsed + resolved[-1].duration - time_elapsed)
-            states.append(state)
-            if resolved:
-                states += resolved
-                state = resolved[-1]
-        else:
-            if active_label_definition:
-                labels[active_label_definition]['instructions'].append(token)
-            if isinstance(token, RelativeOctaveInstruction):
-                state = state._replace(current_octave=state.current_octave + token.value)
-            elif isinstance(token, AbsoluteOctaveInstruction):
-                state = state._replace(current_octave=token.value)
-            elif isinstance(token, TempoInstruction):
-                state = state._replace(tempo=token.value)
-            elif isinstance(token, LengthInstruction):
-                state = state._replace(current_length=token.value)
-            elif isinstance(token, PauseInstruction):
-                state = state._replace(duration=calculate_duration(state.tempo, token.value or state.current_length))
-            elif isinstance(token, NoteInstruction):
-                state = state._replace(duration=calculate_duration(state.tempo, state.current_length))
-            elif isinstance(token, MultipleNotesDelimiterInstruction):
-                state = state._replace(simultaneous_notes=not state.simultaneous_notes, time_elapsed=max_time_elapsed)
-            states.append(state)
-        token = next(instructions, None)
-    return states
+                # the labels being defined here are being compiled too, as far
+                # as references in them are concerned
+                referenced_from = compiling.union(label_index for _, label_index in open_labels)
+                if definition.index in referenced_from or any(name == token.value for name, _ in open_labels):
+                    self.recursive_references_skipped += 1
+                    continue
+                block, relative_octave = self.compile_label(definition, state, referenced_from)
+                if block:
+                    octave_offset = state.current_octave if relative_octave else 0
+                    resolved = self.place_label_block(block, time_elapsed, octave_offset)
+                    # ensure the state duration covers all label instructions, so the reference can be highlighted...
+                    state = state._replace(duration=resolved[-1].time_elapsed + resolved[-1].duration - time_elapsed)
+                    states.append(state)
+                    states += resolved
+                    state = resolved[-1]
+                else:
+                    states.append(state)
+            else:
+                if isinstance(token, RelativeOctaveInstruction):
+                    state = state._replace(current_octave=state.current_octave + token.value)
+                elif isinstance(token, AbsoluteOctaveInstruction):
+                    state = state._replace(current_octave=token.value)
+                elif isinstance(token, TempoInstruction):
+                    state = state._replace(tempo=token.value)
+                elif isinstance(token, LengthInstruction):
+                    state = state._replace(current_length=token.value)
+                elif isinstance(token, PauseInstruction):
+                    state = state._replace(duration=calculate_duration(state.tempo, token.value or state.current_length))
+                elif isinstance(token, NoteInstruction):
+                    state = state._replace(duration=calculate_duration(state.tempo, state.current_length))
+                elif isinstance(token, MultipleNotesDelimiterInstruction):
+                    state = state._replace(simultaneous_notes=not state.simultaneous_notes, time_elapsed=max_time_elapsed)
+                states.append(state)
+
+            if on_checkpoint:
+                until_checkpoint -= 1
+                if until_checkpoint <= 0 and not open_labels:
+                    until_checkpoint = checkpoint_interval
+                    on_checkpoint(ResolverCheckpoint(token.span.end(), state, max_time_elapsed, dict(self.labels), index + 1))
+
+        return state, max_time_elapsed
+
+def resolve_piano_tune_instructions(instructions: Iterable[TuneInstruction], default_state=DEFAULT_TUNE_STATE):
+    """from the piano tune instructions, determine the state at each instruction,
+    specifically how much time has passed since the beginning of the tune"""
+    return TuneResolver(default_state).resolve(instructions)
+
+def label_signature(labels: dict):
+    """what the label definitions of a tune play, in order, ignoring where
+    they are; it only changes when a label definition is changed"""
+    definitions = sorted(chain.from_iterable(labels.values()), key=attrgetter('index'))
+    return tuple(
+        (definition.start.value, tuple((type(instruction), instruction.value) for instruction in definition.body))
+        for definition in definitions
+    )
+
+class TuneCheckpoints:
+    """a cache of resolver checkpoints for a tune, ordered by offset, so that
+    the state at any point can be resolved from the nearest checkpoint before
+    it instead of from the start of the tune.
+
+    Labels can be referenced before they are defined, so the label definitions
+    of the whole tune are found before resolving part of it, and cached until
+    the tune is edited. Every checkpoint depends on them, so they are all
+    forgotten when a label definition changes, wherever it is."""
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        self.offsets = list()
+        self.checkpoints = list()
+        # the label definitions of the whole tune, or None if it has been
+        # edited since they were found
+        self.labels = None
+        self.label_signature = None
+
+    def add(self, checkpoint: ResolverCheckpoint):
+        index = bisect_left(self.offsets, checkpoint.offset)
+        if index < len(self.offsets) and self.offsets[index] == checkpoint.offset:
+            return
+        self.offsets.insert(index, checkpoint.offset)
+        self.checkpoints.insert(index, checkpoint)
+
+    def nearest(self, point: int):
+        """the last checkpoint before point, or None if there isn't one"""
+        index = bisect_left(self.offsets, point)
+        return self.checkpoints[index - 1] if index else None
+
+    def invalidate(self, offset: int):
+        """forget the checkpoints at or after offset, i.e. because it was edited"""
+        index = bisect_left(self.offsets, offset)
+        del self.offsets[index:]
+        del self.checkpoints[index:]
+        self.labels = None
+
+    def link(self, tune_instructions):
+        """the label definitions of the whole tune; tune_instructions is called
+        for the instructions of the whole tune if they aren't cached"""
+        if self.labels is None:
+            resolver = TuneResolver()
+            resolver.link(list(tune_instructions()), 0)
+            signature = label_signature(resolver.labels)
+            if signature != self.label_signature:
+                self.invalidate(0)
+            self.labels = resolver.labels
+            self.label_signature = signature
+        return self.labels
+
+    def resolve(self, instructions_from, point: int, tune_instructions):
+        """resolve the tune up to point, starting from the nearest checkpoint;
+        instructions_from is called with the offset to start parsing from,
+        and tune_instructions for the whole tune, to find its labels.
+        Returns the resolved states and the resolver used, so the caller can
+        take a checkpoint at point"""
+        labels = self.link(tune_instructions)
+        checkpoint = self.nearest(point)
+        resolver = TuneResolver(checkpoint=checkpoint, labels=labels)
+        states = resolver.resolve(instructions_from(checkpoint.offset if checkpoint else 0), self.add, self.interval)
+        return states, resolver
+
+def state_is_interesting(state: TuneState):
+    """whether the state is a note or something to highlight, like a pause"""
+    return isinstance(state.instruction, (NoteInstruction, PauseInstruction, LabelReferenceInstruction))
+
+def iter_piano_tune_midi(tune_states: Iterable[TuneState]):
+    """from the piano tune states, lazily yield the timings for what tokens to
+    highlight and what midi notes to play, in time order. The "on" events come
+    straight from the states (which are already in time order) and are merged
+    with a heap of the pending "off" events, so nothing needs to be sorted up
+    front and the first events are available immediately"""
+    pending_offs = list()
+    sequence = 0
+    for state in tune_states:
+        if not state_is_interesting(state):
+            continue
+        # NOTE: offs at the same time as an on go first, just like sorting does
+        while pending_offs and pending_offs[0][0] <= state.time_elapsed:
+            yield heappop(pending_offs)[2]
+        yield PianoTuneMidiHighlight(state, True, state.time_elapsed)
+        time_elapsed = state.time_elapsed + state.duration
+        heappush(pending_offs, (time_elapsed, sequence, PianoTuneMidiHighlight(state, False, time_elapsed)))
+        sequence += 1
+
+    while pending_offs:
+        yield heappop(pending_offs)[2]
 
 def convert_piano_tune_to_midi(tune_states):
     """from the piano tune states, return the timings for what tokens to highlight
     and what midi notes to play"""
+    # NOTE: the states are very nearly in order already, so the stable sort
+    #       here is cheap, and keeps the order correct for tunes where they aren't
+    return sorted(iter_piano_tune_midi(tune_states), key=attrgetter('time_elapsed'))
 
-    # reduce states to those that are notes or something to highlight, like pauses
-    def state_is_interesting(state):
-        return isinstance(state.instruction, NoteInstruction) \
-            or isinstance(state.instruction, PauseInstruction) \
-            or isinstance(state.instruction, LabelReferenceInstruction)
-    tune_states = list(state for state in tune_states if state_is_interesting(state))
+# The kinds of instruction kept in a CompiledTune
+KIND_NOTE = 1
+KIND_PAUSE = 2
+KIND_LABEL_REFERENCE = 3
 
-    # for each state, add an "off" state after the duration
-    add_states = list()
-    for state in tune_states:
-        add_states.append(
-            PianoTuneMidiHighlight(state, True, state.time_elapsed)
-        )
-        add_states.append(
-            PianoTuneMidiHighlight(state, False, state.time_elapsed + state.duration)
-        )
-    add_states.sort(key=attrgetter('time_elapsed'))
-    return add_states
+INSTRUCTION_KINDS = {
+    NoteInstruction: KIND_NOTE,
+    PauseInstruction: KIND_PAUSE,
+    LabelReferenceInstruction: KIND_LABEL_REFERENCE,
+}
+
+DEFAULT_VELOCITY = 64
+
+class CompiledTune:
+    """a compact, column based form of a compiled tune; rather than a TuneState,
+    an instruction and two PianoTuneMidiHighlights for every note, the tune is
+    stored as a handful of arrays, with one entry per note, pause or label
+    reference. The events are iterated as lightweight CompiledEvent views"""
+    __slots__ = ('time', 'duration', 'note', 'velocity', 'channel', 'span_begin', 'span_end', 'kind', 'event_order')
+
+    def __init__(self):
+        self.time = array('d')
+        self.duration = array('d')
+        self.note = array('h') # the midi note, only meaningful for KIND_NOTE
+        self.velocity = array('B')
+        self.channel = array('B')
+        self.span_begin = array('i')
+        self.span_end = array('i')
+        self.kind = array('B')
+        # the order of the on/off events, each stored as index << 1 | on
+        self.event_order = array('I')
+
+    def columns(self):
+        return tuple(getattr(self, name) for name in CompiledTune.__slots__)
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, state: TuneState):
+        """add a state to the tune, if it's one that needs to be kept"""
+        kind = INSTRUCTION_KINDS.get(type(state.instruction))
+        if kind is None:
+            return
+        span = state.instruction.span
+        self.time.append(state.time_elapsed)
+        self.duration.append(state.duration)
+        self.note.append(note_to_midi_note(state.current_octave, state.instruction.value) if kind == KIND_NOTE else 0)
+        self.velocity.append(DEFAULT_VELOCITY)
+        self.channel.append(0)
+        self.span_begin.append(span.begin())
+        self.span_end.append(span.end())
+        self.kind.append(kind)
+
+    def __iadd__(self, states: Iterable[TuneState]):
+        for state in states:
+            self.append(state)
+        return self
+
+    def finish(self):
+        """work out the order of the events, once all states have been added;
+        this is the same heap merge as iter_piano_tune_midi does"""
+        event_order = array('I')
+        pending_offs = list()
+        time = self.time
+        duration = self.duration
+        for index in range(len(time)):
+            while pending_offs and pending_offs[0][0] <= time[index]:
+                event_order.append(heappop(pending_offs)[1] << 1)
+            event_order.append(index << 1 | 1)
+            heappush(pending_offs, (time[index] + duration[index], index))
+        while pending_offs:
+            event_order.append(heappop(pending_offs)[1] << 1)
+        self.event_order = event_order
+        return self
+
+    def events(self, start=0):
+        """iterate the on/off events in time order, from the given position in
+        event_order"""
+        for position in range(start, len(self.event_order)):
+            event = self.event_order[position]
+            yield CompiledEvent(self, event >> 1, event & 1 == 1)
+
+class CompiledEvent:
+    """a view of an on or off event in a CompiledTune, with the same interface
+    as PianoTuneMidiHighlight uses for playback and export"""
+    __slots__ = ('tune', 'index', 'on')
+
+    def __init__(self, tune: CompiledTune, index: int, on: bool):
+        self.tune = tune
+        self.index = index
+        self.on = on
+
+    @property
+    def time_elapsed(self):
+        if self.on:
+            return self.tune.time[self.index]
+        return self.tune.time[self.index] + self.tune.duration[self.index]
+
+    @property
+    def midi_note(self):
+        if self.tune.kind[self.index] != KIND_NOTE:
+            return None
+        return self.tune.note[self.index]
+
+    @property
+    def span(self):
+        return Region(self.tune.span_begin[self.index], self.tune.span_end[self.index])
+
+    def to_midi_message(self, time_delta):
+        if self.tune.kind[self.index] != KIND_NOTE:
+            return None
+        if self.on:
+            return mido.Message('note_on', note=self.tune.note[self.index], velocity=self.tune.velocity[self.index], channel=self.tune.channel[self.index], time=int(time_delta))
+        return mido.Message('note_off', note=self.tune.note[self.index], channel=self.tune.channel[self.index], time=int(time_delta))
+
+# How many events apart the sets of playing instructions are kept in a
+# TuneTimeIndex
+TIME_INDEX_SNAPSHOT_INTERVAL = 1024
+
+class TuneTimeIndex:
+    """the events of a finished CompiledTune indexed by time and by source
+    offset, so that playback can seek to any point of the tune with a bisect.
+    It's built from the tune's columns when it's needed, rather than being
+    kept in the compiled tune cache.
+
+    The instructions that are playing before each event are worked out from
+    a snapshot taken every TIME_INDEX_SNAPSHOT_INTERVAL events, so seeking
+    doesn't need to replay the tune from the start."""
+    def __init__(self, tune: CompiledTune):
+        self.tune = tune
+        # the time of each event, in the order of tune.event_order
+        self.event_time = array('d')
+        # the instructions that are playing before every
+        # TIME_INDEX_SNAPSHOT_INTERVAL'th event, as sets of tune indexes
+        self.snapshots = list()
+        playing = set()
+        for position, event in enumerate(tune.event_order):
+            if position % TIME_INDEX_SNAPSHOT_INTERVAL == 0:
+                self.snapshots.append(frozenset(playing))
+            index = event >> 1
+            if event & 1:
+                playing.add(index)
+                self.event_time.append(tune.time[index])
+            else:
+                playing.discard(index)
+                self.event_time.append(tune.time[index] + tune.duration[index])
+
+        # the source offset of each instruction, sorted, and the time it
+        # first plays; an instruction in a label plays each time the label
+        # is referenced, and sorting puts its earliest time first
+        by_offset = sorted(zip(tune.span_begin, tune.time))
+        self.offset_begin = array('i', (begin for begin, _ in by_offset))
+        self.offset_time = array('d', (time_elapsed for _, time_elapsed in by_offset))
+
+    def __len__(self):
+        return len(self.event_time)
+
+    @property
+    def duration(self):
+        return self.event_time[-1] if self.event_time else 0
+
+    def position_at(self, time_elapsed):
+        """the position in event_order of the first event at or after
+        time_elapsed"""
+        return bisect_left(self.event_time, time_elapsed)
+
+    def time_at_offset(self, offset):
+        """the time the first instruction at or after the source offset first
+        plays, or the duration of the tune if there isn't one"""
+        index = bisect_left(self.offset_begin, offset)
+        if index >= len(self.offset_begin):
+            return self.duration
+        return self.offset_time[index]
+
+    def playing_at(self, position):
+        """the set of tune indexes of the instructions that are playing just
+        before the event at position"""
+        if not self.snapshots:
+            return set()
+        snapshot = min(position // TIME_INDEX_SNAPSHOT_INTERVAL, len(self.snapshots) - 1)
+        playing = set(self.snapshots[snapshot])
+        for event in self.tune.event_order[snapshot * TIME_INDEX_SNAPSHOT_INTERVAL:position]:
+            if event & 1:
+                playing.add(event >> 1)
+            else:
+                playing.discard(event >> 1)
+        return playing
+
+def compile_piano_tune(instructions: Iterable[TuneInstruction]):
+    """resolve the piano tune instructions straight into a CompiledTune,
+    without keeping the state of every instruction along the way"""
+    tune = CompiledTune()
+    TuneResolver().resolve(instructions, states=tune)
+    return tune.finish()
+
+def convert_piano_tune_text_to_midi(text: str):
+    """run the whole pipeline on the text of a piano tune, without needing a view"""
+    instructions = parse_piano_tune(tokenize_piano_tune(text))
+    return convert_piano_tune_to_midi(resolve_piano_tune_instructions(instructions))
+
+def compile_piano_tune_text(text: str):
+    """compile the text of a piano tune to a CompiledTune, without needing a view"""
+    return compile_piano_tune(parse_piano_tune(tokenize_piano_tune(text)))
+
+def piano_tune_to_midi_file(events):
+    """write the on/off events of a compiled tune to a new type 0 mido.MidiFile"""
+    mid = mido.MidiFile(type=0)
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+
+    time_elapsed = 0
+    for item in events:
+        # NOTE: the events are streamed rather than sorted, so guard
+        #       against a note that starts fractionally early
+        time_delta = max(0, item.time_elapsed - time_elapsed)
+        msg = item.to_midi_message(time_delta)
+        if msg:
+            track.append(msg)
+            time_elapsed = item.time_elapsed
+    return mid
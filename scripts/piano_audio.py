@@ -0,0 +1,144 @@
+import os
+import sys
+import wave
+from typing import NamedTuple
+try:
+    import numpy
+except ImportError:
+    # NOTE: numpy is only needed to render piano-tunes to audio, so exporting
+    #       midi with piano_batch_export works without it
+    numpy = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import piano_tunes
+
+
+SAMPLE_RATE = 44100
+
+# The relative amplitudes of the harmonics of each note, from the
+# fundamental up; they fall off quickly, for a soft, roughly piano like tone
+HARMONICS = (1.0, 0.5, 0.3, 0.15, 0.08, 0.04)
+
+# The number of samples in one cycle of each wavetable
+WAVETABLE_SIZE = 2048
+
+# The level the loudest sample of a rendered tune is scaled to, so every
+# preview comes out at the same volume without clipping
+PEAK_LEVEL = 0.9
+
+
+class Envelope(NamedTuple):
+    """an ADSR envelope; the times are in seconds, and sustain is a level"""
+    attack: float = 0.005
+    decay: float = 0.4
+    sustain: float = 0.35
+    release: float = 0.25
+
+
+def note_frequency(midi_note):
+    return 440 * 2 ** ((midi_note - 69) / 12)
+
+
+class PianoTuneRenderer:
+    """
+    Renders the notes of a CompiledTune to audio samples with a wavetable
+    synth, using numpy. Each note is a block of samples, worked out for the
+    whole block at once; tunes repeat the same notes at the same lengths a
+    lot, so the blocks are cached by note, length and velocity, and most notes
+    are just added into the mix at their start time.
+    """
+    def __init__(self, sample_rate=SAMPLE_RATE, envelope=Envelope(), harmonics=HARMONICS):
+        if numpy is None:
+            raise ImportError('rendering piano-tunes to audio needs numpy')
+        self.sample_rate = sample_rate
+        self.envelope = envelope
+        self.harmonics = harmonics
+        # a wavetable for each number of harmonics, since the higher notes
+        # have to drop the harmonics that would be above the Nyquist frequency
+        self.wavetables = dict()
+        self.blocks = dict()
+
+    def wavetable(self, harmonic_count):
+        table = self.wavetables.get(harmonic_count)
+        if table is None:
+            phase = numpy.arange(WAVETABLE_SIZE + 1) * (2 * numpy.pi / WAVETABLE_SIZE)
+            table = sum(amplitude * numpy.sin(phase * harmonic) for harmonic, amplitude in enumerate(self.harmonics[:harmonic_count], 1))
+            table /= numpy.abs(table).max()
+            self.wavetables[harmonic_count] = table
+        return table
+
+    def envelope_samples(self, held):
+        """the envelope of a note held for held samples, and then released"""
+        envelope = self.envelope
+        attack = max(1, int(envelope.attack * self.sample_rate))
+        decay = max(1, int(envelope.decay * self.sample_rate))
+        release = max(1, int(envelope.release * self.sample_rate))
+        t = numpy.arange(held, dtype=numpy.float64)
+        levels = numpy.where(
+            t < attack,
+            t / attack,
+            numpy.maximum(envelope.sustain, 1 - (1 - envelope.sustain) * (t - attack) / decay)
+        )
+        # NOTE: the release starts from whatever level the note had reached,
+        #       which isn't the sustain level if it's released early
+        release_level = levels[-1] if held else 0
+        return numpy.concatenate((levels, numpy.linspace(release_level, 0, release)))
+
+    def block(self, midi_note, held, velocity):
+        """the samples of a note held for held samples, at a velocity"""
+        key = (midi_note, held, velocity)
+        block = self.blocks.get(key)
+        if block is None:
+            frequency = note_frequency(midi_note)
+            harmonic_count = max(1, min(len(self.harmonics), int(self.sample_rate / 2 // frequency)))
+            table = self.wavetable(harmonic_count)
+            envelope = self.envelope_samples(held)
+            # read the wavetable at the note's frequency, interpolating
+            # between its samples
+            position = (numpy.arange(len(envelope)) * (frequency * WAVETABLE_SIZE / self.sample_rate)) % WAVETABLE_SIZE
+            index = position.astype(numpy.int64)
+            fraction = position - index
+            samples = table[index] + (table[index + 1] - table[index]) * fraction
+            block = samples * envelope * (velocity / 127)
+            self.blocks[key] = block
+        return block
+
+    def render(self, tune: piano_tunes.CompiledTune):
+        """the samples of the whole tune, as floats in -PEAK_LEVEL..PEAK_LEVEL"""
+        # the columns of the tune are arrays, so they can be read by numpy
+        # without copying them
+        kind = numpy.frombuffer(tune.kind, dtype=numpy.uint8)
+        notes = numpy.flatnonzero(kind == piano_tunes.KIND_NOTE)
+        starts = numpy.rint(numpy.frombuffer(tune.time, dtype=numpy.float64)[notes] * self.sample_rate / 1000).astype(numpy.int64)
+        helds = numpy.rint(numpy.frombuffer(tune.duration, dtype=numpy.float64)[notes] * self.sample_rate / 1000).astype(numpy.int64)
+        midi_notes = numpy.frombuffer(tune.note, dtype=numpy.int16)[notes]
+        velocities = numpy.frombuffer(tune.velocity, dtype=numpy.uint8)[notes]
+
+        release = max(1, int(self.envelope.release * self.sample_rate))
+        length = int((starts + helds).max()) + release if len(notes) else 0
+        mix = numpy.zeros(length)
+        for start, held, midi_note, velocity in zip(starts.tolist(), helds.tolist(), midi_notes.tolist(), velocities.tolist()):
+            block = self.block(midi_note, max(0, held), velocity)
+            mix[start:start + len(block)] += block
+
+        peak = numpy.abs(mix).max() if length else 0
+        if peak > 0:
+            mix *= PEAK_LEVEL / peak
+        return mix
+
+
+def write_wav(file_name, samples, sample_rate=SAMPLE_RATE):
+    """write samples, as floats in -1..1, to a mono 16 bit wav file"""
+    pcm = numpy.clip(numpy.rint(samples * 32767), -32768, 32767).astype('<i2')
+    with wave.open(file_name, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes(pcm.tobytes())
+
+
+def piano_tune_to_wav_file(tune: piano_tunes.CompiledTune, file_name, sample_rate=SAMPLE_RATE, envelope=Envelope()):
+    """render a compiled tune to a wav file; returns its length in seconds"""
+    samples = PianoTuneRenderer(sample_rate, envelope).render(tune)
+    write_wav(file_name, samples, sample_rate)
+    return len(samples) / sample_rate
@@ -0,0 +1,125 @@
+"""
+Export whole directories of piano-tunes to midi files, outside of Sublime Text.
+
+    python scripts/piano_batch_export.py [--jobs N] [--force] [--output-dir DIR] [--format wav] PATH...
+
+Each PATH can be a piano-tune file, or a directory which is searched for them
+recursively. Tunes are compiled and written in parallel, using a process pool;
+a tune is skipped when its midi file is newer than it, unless --force is given.
+The midi file is written next to the tune, as the Export Midi command does, or
+to the same relative path under --output-dir.
+
+With --format wav, the tunes are rendered to wav files with piano_audio's
+synth instead, which needs numpy but no midi ports or sound hardware, i.e. to
+make audio previews of the tunes in CI.
+"""
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import piano_tunes
+import piano_audio
+
+
+PIANO_TUNE_EXTENSION = '.piano-tune'
+
+# The extension of the files written for each output format
+OUTPUT_EXTENSIONS = {
+    'midi': '.mid',
+    'wav': '.wav',
+}
+
+
+def find_piano_tunes(paths):
+    """yield (tune file name, base directory) for each piano-tune in paths"""
+    for base in paths:
+        if os.path.isfile(base):
+            yield base, os.path.dirname(base)
+            continue
+        for directory, _, file_names in os.walk(base):
+            for file_name in sorted(file_names):
+                if file_name.endswith(PIANO_TUNE_EXTENSION):
+                    yield os.path.join(directory, file_name), base
+
+
+def output_file_name(tune_file_name, base, output_dir=None, output_format='midi'):
+    output_file_name = os.path.splitext(tune_file_name)[0] + OUTPUT_EXTENSIONS[output_format]
+    if output_dir:
+        output_file_name = os.path.join(output_dir, os.path.relpath(output_file_name, base))
+    return output_file_name
+
+
+def is_up_to_date(tune_file_name, output_file_name):
+    try:
+        return os.path.getmtime(output_file_name) >= os.path.getmtime(tune_file_name)
+    except OSError:
+        return False
+
+
+def export_piano_tune(tune_file_name, output_file_name, output_format='midi'):
+    """compile and export a single tune; returns (seconds taken, error), where
+    error is None if the export succeeded. This runs in the worker processes"""
+    start = time.perf_counter()
+    try:
+        with open(tune_file_name, encoding='utf-8') as file:
+            tune = piano_tunes.compile_piano_tune_text(file.read())
+        os.makedirs(os.path.dirname(output_file_name) or '.', exist_ok=True)
+        if output_format == 'wav':
+            piano_audio.piano_tune_to_wav_file(tune, output_file_name)
+        else:
+            piano_tunes.piano_tune_to_midi_file(tune.events()).save(output_file_name)
+    except Exception:
+        return time.perf_counter() - start, traceback.format_exc()
+    return time.perf_counter() - start, None
+
+
+def batch_export(paths, jobs=None, force=False, output_dir=None, log=print, output_format='midi'):
+    """export every piano-tune found in paths; returns a list of
+    (tune file name, status, seconds), where status is 'exported', 'skipped'
+    or the error that stopped the tune from exporting"""
+    results = list()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = dict()
+        for tune_file_name, base in find_piano_tunes(paths):
+            destination = output_file_name(tune_file_name, base, output_dir, output_format)
+            if not force and is_up_to_date(tune_file_name, destination):
+                results.append((tune_file_name, 'skipped', 0))
+                log('skipped   %s' % tune_file_name)
+                continue
+            futures[executor.submit(export_piano_tune, tune_file_name, destination, output_format)] = tune_file_name
+
+        for future in as_completed(futures):
+            tune_file_name = futures[future]
+            seconds, error = future.result()
+            results.append((tune_file_name, error or 'exported', seconds))
+            if error:
+                log('FAILED    %s (%.3f s)\n%s' % (tune_file_name, seconds, error))
+            else:
+                log('exported  %s (%.3f s)' % (tune_file_name, seconds))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export piano-tunes to midi or wav files.')
+    parser.add_argument('paths', nargs='+', help='piano-tune files, or directories to search for them')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('-f', '--force', action='store_true', help='export tunes even if their midi file is up to date')
+    parser.add_argument('-o', '--output-dir', default=None, help='write the exported files under this directory')
+    parser.add_argument('--format', choices=sorted(OUTPUT_EXTENSIONS), default='midi', help='export midi files, or render wav files (which needs numpy)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = batch_export(args.paths, args.jobs, args.force, args.output_dir, output_format=args.format)
+    failed = sum(1 for _, status, _ in results if status not in ('exported', 'skipped'))
+    exported = sum(1 for _, status, _ in results if status == 'exported')
+    skipped = sum(1 for _, status, _ in results if status == 'skipped')
+    print('%d exported, %d skipped, %d failed in %.3f s' % (exported, skipped, failed, time.perf_counter() - start))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Tests for the playback scheduler, run outside of Sublime Text with only mido
+installed:
+
+    python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mido
+import piano_playback
+import piano_smf
+
+
+class CountingStream(piano_playback.PlaybackStream):
+    """plays a fixed number of events, one every interval seconds"""
+    def __init__(self, scheduler, events, fail=False, interval=0.001):
+        super().__init__(scheduler)
+        self.events = events
+        self.interval = interval
+        self.fail = fail
+        self.played = 0
+        self.finished = threading.Event()
+        self.on_finish = lambda stream: stream.finished.set()
+
+    def start(self, now):
+        self.next_time = now
+
+    def deadline(self):
+        return self.next_time
+
+    def play_due(self, now, audible):
+        if self.fail:
+            raise ValueError('port closed')
+        self.played += 1
+        self.next_time += self.interval
+
+    def done(self):
+        return self.stopped or self.played >= self.events
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_failing_stream_only_stops_itself(self):
+        scheduler = piano_playback.PlaybackScheduler(spin=False)
+        try:
+            failing = CountingStream(scheduler, 10, fail=True)
+            playing = CountingStream(scheduler, 10)
+            scheduler.add(failing, playing)
+            self.assertTrue(failing.finished.wait(1))
+            self.assertTrue(playing.finished.wait(1))
+            self.assertEqual(playing.played, 10)
+            self.assertTrue(scheduler.thread.is_alive())
+        finally:
+            scheduler.stop()
+
+    def test_spinning_does_not_hold_the_lock(self):
+        spin_threshold = piano_playback.SPIN_THRESHOLD
+        piano_playback.SPIN_THRESHOLD = 0.5
+        scheduler = piano_playback.PlaybackScheduler(spin=True)
+        try:
+            stream = CountingStream(scheduler, 2, interval=0.3)
+            scheduler.add(stream)
+            # the first event is due straight away, and the scheduler spins
+            # for the whole of the wait for the second
+            time.sleep(0.1)
+            started = time.perf_counter()
+            with scheduler.condition:
+                self.assertLess(time.perf_counter() - started, 0.1)
+            self.assertTrue(stream.finished.wait(1))
+        finally:
+            piano_playback.SPIN_THRESHOLD = spin_threshold
+            scheduler.stop()
+
+
+def midi_file_bytes():
+    """a two track midi file, with running status, a tempo change and sysex"""
+    midi = mido.MidiFile()
+    first = mido.MidiTrack([
+        mido.MetaMessage('set_tempo', tempo=400000),
+        mido.Message('program_change', channel=1, program=5),
+        mido.Message('control_change', channel=1, control=7, value=90),
+        mido.Message('note_on', channel=1, note=60, velocity=80, time=120),
+        mido.Message('note_on', channel=1, note=64, velocity=70),
+        mido.Message('note_on', channel=1, note=60, velocity=0, time=240),
+        mido.Message('pitchwheel', channel=1, pitch=-1234, time=10),
+        mido.Message('note_off', channel=1, note=64, time=100),
+    ])
+    second = mido.MidiTrack([
+        mido.Message('sysex', data=[1, 2, 3], time=60),
+        mido.Message('note_on', channel=2, note=40, velocity=100, time=60),
+        mido.Message('pitchwheel', channel=2, pitch=4000, time=200),
+    ])
+    midi.tracks.extend((first, second))
+    buffer = io.BytesIO()
+    midi.save(file=buffer)
+    return buffer.getvalue()
+
+
+class MidiFileEventsTest(unittest.TestCase):
+    def test_events_match_mido(self):
+        data = midi_file_bytes()
+        expected = list()
+        seconds = 0
+        for msg in mido.MidiFile(file=io.BytesIO(data)):
+            seconds += msg.time
+            if not msg.is_meta:
+                expected.append((seconds, msg.copy(time=0)))
+
+        events = piano_playback.MidiFileEvents()
+        for seconds, message in piano_smf.MidiFileBuffer(data):
+            events.append(seconds, message)
+
+        self.assertEqual(len(events), len(expected))
+        for index, (seconds, msg) in enumerate(expected):
+            self.assertAlmostEqual(events.times[index], seconds)
+            self.assertEqual(mido.Message.from_bytes(events.messages[index]), msg)
+
+            # the state rebuilt from the bytes matches the messages up to here
+            state = events.state_at(index + 1)
+            self.assertEqual(state.pitch, {
+                earlier.channel: earlier.pitch for _, earlier in expected[:index + 1] if earlier.type == 'pitchwheel'
+            })
+        state = events.state_at(len(events))
+        self.assertEqual(state.notes, {(2, 40): 100})
+        self.assertEqual(state.programs, {1: 5})
+        self.assertEqual(state.controls, {(1, 7): 90})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+"""
+Regression tests for compiling piano-tunes, run outside of Sublime Text with
+only mido installed:
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import piano_tunes
+
+
+def retriggered_notes(events):
+    """how many times a note starts while the same midi note is still on"""
+    sounding = Counter()
+    retriggered = 0
+    for item in events:
+        midi_note = item.midi_note
+        if midi_note is None:
+            continue
+        if item.on:
+            retriggered += sounding[midi_note] > 0
+            sounding[midi_note] += 1
+        else:
+            sounding[midi_note] -= 1
+    return retriggered
+
+
+class LabelTest(unittest.TestCase):
+    def test_repeated_notes_in_label_are_not_cut_off(self):
+        # the times of a label's notes used to be shifted by the time of the
+        # reference, and the rounding put each note a hair before the end of
+        # the one before it, so the repeated note was turned off at once
+        for tempo, length in ((97, 3), (120, 4), (113, 6), (77, 7)):
+            text = 't%d l%d p3 x: %s---\n%s' % (tempo, length, 'c ' * 20, '&x ' * 5)
+            with self.subTest(tempo=tempo, length=length):
+                tune = piano_tunes.compile_piano_tune_text(text)
+                self.assertEqual(retriggered_notes(tune.events()), 0)
+                self.assertEqual(retriggered_notes(piano_tunes.convert_piano_tune_text_to_midi(text)), 0)
+
+    def test_label_times_match_resolving_in_place(self):
+        text = 't97 l3 c d e x: c d e /c e/ f ---\n&x g &x'
+        inline = 't97 l3 c d e c d e /c e/ f c d e /c e/ f g c d e /c e/ f'
+        referenced = [item.time_elapsed for item in piano_tunes.compile_piano_tune_text(text).events() if item.midi_note is not None]
+        expected = [item.time_elapsed for item in piano_tunes.compile_piano_tune_text(inline).events()]
+        self.assertEqual(referenced, expected)
+
+
+    def test_recursive_labels_do_not_depend_on_compile_order(self):
+        # x refers to itself through y; where x is defined it plays c and y's
+        # d, and a later reference to x has to play the same
+        notes = [item.midi_note for item in piano_tunes.compile_piano_tune_text('x: c &y --- y: d &x --- &x').events() if item.on and item.midi_note is not None]
+        self.assertEqual(notes, [48, 50, 50, 48, 48, 50])
+
+
+def scopes(text):
+    """the (text, scope) of each token, without the base scope and the spaces"""
+    return [
+        (token.text.strip(), token.scope[len('text.piano-tune '):].strip())
+        for token in piano_tunes.tokenize_piano_tune(text) if token.text.strip()
+    ]
+
+
+class TokenizeTest(unittest.TestCase):
+    # the scopes PianoTune.sublime-syntax gives each construct
+    def test_notes(self):
+        self.assertEqual(scopes('c G# do SOL#'), [
+            ('c', 'constant.language.note.letter.piano-tune'),
+            ('G', 'constant.language.note.letter.piano-tune'),
+            ('#', 'constant.language.sharp.piano-tune'),
+            ('do', 'constant.language.note.solfege.piano-tune'),
+            ('SOL', 'constant.language.note.solfege.piano-tune'),
+            ('#', 'constant.language.sharp.piano-tune'),
+        ])
+
+    def test_octave_length_tempo_and_pause(self):
+        self.assertEqual(scopes('o4 > < l8 t120 p16'), [
+            ('o', 'keyword.operator.octave.piano-tune'),
+            ('4', 'constant.numeric.integer.decimal.piano-tune'),
+            ('>', 'keyword.operator.bitwise.octave.piano-tune'),
+            ('<', 'keyword.operator.bitwise.octave.piano-tune'),
+            ('l', 'keyword.operator.length.piano-tune'),
+            ('8', 'constant.numeric.integer.decimal.piano-tune'),
+            ('t', 'keyword.operator.tempo.piano-tune'),
+            ('120', 'constant.numeric.integer.decimal.piano-tune'),
+            ('p', 'keyword.operator.pause.piano-tune'),
+            ('16', 'constant.numeric.integer.decimal.piano-tune'),
+        ])
+
+    def test_labels_and_references(self):
+        self.assertEqual(scopes('verse-1: c --- &verse-1'), [
+            ('verse-1', 'entity.name.label.piano-tune'),
+            (':', 'punctuation.section.block.begin.piano-tune'),
+            ('c', 'constant.language.note.letter.piano-tune'),
+            ('---', 'punctuation.section.block.end.piano-tune'),
+            ('&', 'keyword.control.flow.piano-tune'),
+            ('verse-1', 'support.function.piano-tune'),
+        ])
+
+    def test_chords(self):
+        self.assertEqual(scopes('/c > e#/ g'), [
+            ('/', 'meta.group.simultaneous.piano-tune keyword.operator.simultaneous.begin.piano-tune'),
+            ('c', 'meta.group.simultaneous.piano-tune constant.language.note.letter.piano-tune'),
+            ('>', 'meta.group.simultaneous.piano-tune keyword.operator.bitwise.octave.piano-tune'),
+            ('e', 'meta.group.simultaneous.piano-tune constant.language.note.letter.piano-tune'),
+            ('#', 'meta.group.simultaneous.piano-tune constant.language.sharp.piano-tune'),
+            ('/', 'meta.group.simultaneous.piano-tune keyword.operator.simultaneous.end.piano-tune'),
+            ('g', 'constant.language.note.letter.piano-tune'),
+        ])
+
+    def test_comments(self):
+        # a block comment carries on over lines, and a chord can hold one
+        self.assertEqual(scopes('c // d e\n/* f\ng */ /a /* b */ c/'), [
+            ('c', 'constant.language.note.letter.piano-tune'),
+            ('//', 'comment.line.piano-tune punctuation.definition.comment.piano-tune'),
+            ('d e', 'comment.line.piano-tune'),
+            ('/*', 'comment.block.piano-tune punctuation.definition.comment.begin.piano-tune'),
+            ('f', 'comment.block.piano-tune'),
+            ('g', 'comment.block.piano-tune'),
+            ('*/', 'comment.block.piano-tune punctuation.definition.comment.end.piano-tune'),
+            ('/', 'meta.group.simultaneous.piano-tune keyword.operator.simultaneous.begin.piano-tune'),
+            ('a', 'meta.group.simultaneous.piano-tune constant.language.note.letter.piano-tune'),
+            ('/*', 'meta.group.simultaneous.piano-tune comment.block.piano-tune punctuation.definition.comment.begin.piano-tune'),
+            ('b', 'meta.group.simultaneous.piano-tune comment.block.piano-tune'),
+            ('*/', 'meta.group.simultaneous.piano-tune comment.block.piano-tune punctuation.definition.comment.end.piano-tune'),
+            ('c', 'meta.group.simultaneous.piano-tune constant.language.note.letter.piano-tune'),
+            ('/', 'meta.group.simultaneous.piano-tune keyword.operator.simultaneous.end.piano-tune'),
+        ])
+
+    def test_regions_are_offset(self):
+        # like Sublime, tokens end at the end of each line
+        tokens = list(piano_tunes.tokenize_piano_tune('c\n  d#', 10))
+        self.assertEqual([(token.region.begin(), token.region.end(), token.text) for token in tokens], [
+            (10, 11, 'c'), (11, 12, '\n'), (12, 14, '  '), (14, 15, 'd'), (15, 16, '#'),
+        ])
+        self.assertTrue(all(token.scope.endswith(' ') for token in tokens))
+
+
+def resolve_up_to(checkpoints, text, point):
+    """resolve text up to point from the nearest checkpoint, the way hovering
+    over a note does, returning the (midi note, time) of the last note"""
+    def instructions_from(offset):
+        return piano_tunes.parse_piano_tune(piano_tunes.tokenize_piano_tune(text[offset:point], offset))
+    def tune_instructions():
+        return piano_tunes.parse_piano_tune(piano_tunes.tokenize_piano_tune(text))
+    states, _ = checkpoints.resolve(instructions_from, point, tune_instructions)
+    state = next(state for state in reversed(states) if isinstance(state.instruction, piano_tunes.NoteInstruction))
+    return piano_tunes.note_to_midi_note(state.current_octave, state.instruction.value), state.time_elapsed
+
+
+def compiled_notes(text):
+    """the (source offset, midi note, time) of each note the tune plays"""
+    tune = piano_tunes.compile_piano_tune_text(text)
+    return [
+        (tune.span_end[item.index], item.midi_note, item.time_elapsed)
+        for item in tune.events() if item.on and item.midi_note is not None
+    ]
+
+
+class CheckpointTest(unittest.TestCase):
+    def assertResolvesLikeCompiling(self, checkpoints, text):
+        for offset, midi_note, time_elapsed in compiled_notes(text):
+            # notes in a label are played again where it's referenced
+            if offset < text.index(':'):
+                self.assertEqual(resolve_up_to(checkpoints, text, offset), (midi_note, time_elapsed))
+
+    def test_forward_reference_resolves_like_compiling(self):
+        # x is only defined after the notes, and sets the octave they play in
+        text = 'o4 &x c d e f g a b c d e f g x: o6 ---'
+        self.assertEqual(compiled_notes(text)[0][1], 72)
+        self.assertResolvesLikeCompiling(piano_tunes.TuneCheckpoints(interval=4), text)
+
+    def test_editing_a_label_invalidates_earlier_checkpoints(self):
+        text = 'c &x d e f g a b c d e f g x: c c ---'
+        checkpoints = piano_tunes.TuneCheckpoints(interval=4)
+        self.assertResolvesLikeCompiling(checkpoints, text)
+
+        # make the label longer; the checkpoints before the edit are after
+        # the reference to it, so their times are out of date
+        edit = text.rindex('c')
+        text = text[:edit] + 'c c c ' + text[edit:]
+        checkpoints.invalidate(edit)
+        self.assertResolvesLikeCompiling(checkpoints, text)
+
+
+if __name__ == '__main__':
+    unittest.main()